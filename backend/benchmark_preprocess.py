@@ -0,0 +1,143 @@
+"""
+画像最適化（preprocess_image）のベンチマーク
+JPEGのDCTスケールデコード（Image.draft）の有無で、処理時間とピークメモリを比較する
+
+    python benchmark_preprocess.py                   # 合成した大きなJPEGで計測
+    python benchmark_preprocess.py --corpus ~/photos # 手元の写真（*.jpg, *.jpeg）で計測
+
+ピークメモリは設定ごとに別プロセスで計測する（最大常駐メモリは減らないため）
+値はコーパス読み込み後からの増分。合成画像は親プロセスで一時ディレクトリに書き出してから渡す
+"""
+
+import argparse
+import glob
+import io
+import json
+import os
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+# 携帯電話のカメラで一般的な解像度
+SYNTHETIC_SIZES = [(4000, 3000), (4032, 3024), (3024, 4032), (6000, 4000)]
+
+
+def synthetic_corpus(count: int) -> list:
+    """写真に近い（滑らかな階調＋細かいノイズ＋文字状の模様）大きなJPEGを作る"""
+    import numpy as np
+    from PIL import Image, ImageDraw
+
+    rng = np.random.default_rng(0)
+    corpus = []
+    for i in range(count):
+        width, height = SYNTHETIC_SIZES[i % len(SYNTHETIC_SIZES)]
+        base = rng.integers(0, 256, size=(height // 16, width // 16, 3), dtype=np.uint8)
+        image = Image.fromarray(base).resize((width, height), Image.Resampling.BICUBIC)
+        noise = rng.integers(-8, 9, size=(height, width, 3), dtype=np.int16)
+        image = Image.fromarray(np.clip(np.asarray(image, dtype=np.int16) + noise, 0, 255).astype(np.uint8))
+        draw = ImageDraw.Draw(image)
+        for line in range(0, height, 90):
+            draw.text((80, line), "OCR benchmark 0123456789 " * 12, fill=(20, 20, 20))
+        output = io.BytesIO()
+        image.save(output, format="JPEG", quality=90)
+        corpus.append(output.getvalue())
+    return corpus
+
+
+def load_corpus(directory: str, count: int) -> list:
+    paths = sorted(
+        glob.glob(os.path.join(directory, "*.jpg")) + glob.glob(os.path.join(directory, "*.jpeg"))
+    )
+    corpus = []
+    for path in paths[:count]:
+        with open(path, "rb") as f:
+            corpus.append(f.read())
+    return corpus
+
+
+def max_rss_mb() -> float:
+    """
+    このプロセスの最大常駐メモリ
+    ru_maxrss は fork 元（合成画像を作った親）の値を引き継ぐため、Linux では exec 後にリセットされる VmHWM を使う
+    """
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # Linux 以外では ru_maxrss（macOS はバイト単位）
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss / (1024 * 1024) if sys.platform == "darwin" else maxrss / 1024
+
+
+def run_worker(args) -> None:
+    """子プロセス側: PREPROCESS_JPEG_DRAFT を環境変数で受け取り、計測結果をJSONで出力する"""
+    import logging
+    logging.disable(logging.WARNING)
+    from main import preprocess_image
+
+    corpus = load_corpus(args.corpus, args.count)
+    baseline = max_rss_mb()
+    timings = []
+    for _ in range(args.repeat):
+        for image_data in corpus:
+            started = time.perf_counter()
+            preprocess_image(image_data)
+            timings.append(time.perf_counter() - started)
+    print(json.dumps({
+        "images": len(corpus),
+        "mean_ms": statistics.mean(timings) * 1000,
+        "p95_ms": sorted(timings)[int(0.95 * (len(timings) - 1))] * 1000,
+        "peak_mb": max_rss_mb() - baseline,
+    }))
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="画像最適化のベンチマーク（JPEGドラフトデコードの有無）")
+    parser.add_argument("--corpus", help="計測に使うJPEGのディレクトリ（省略時は合成画像）")
+    parser.add_argument("--count", type=int, default=8, help="画像の枚数")
+    parser.add_argument("--repeat", type=int, default=3, help="繰り返し回数")
+    parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        run_worker(args)
+        return 0
+
+    with tempfile.TemporaryDirectory() as synthetic_dir:
+        corpus_dir = args.corpus
+        if not corpus_dir:
+            corpus_dir = synthetic_dir
+            for i, image_data in enumerate(synthetic_corpus(args.count)):
+                with open(os.path.join(synthetic_dir, f"{i:03d}.jpg"), "wb") as f:
+                    f.write(image_data)
+
+        results = {}
+        for label, draft in (("full decode", "false"), ("draft decode", "true")):
+            completed = subprocess.run(
+                [sys.executable, os.path.abspath(__file__), "--worker", "--corpus", corpus_dir,
+                 "--count", str(args.count), "--repeat", str(args.repeat)],
+                env=dict(os.environ, PREPROCESS_JPEG_DRAFT=draft),
+                capture_output=True, text=True, check=True,
+                cwd=os.path.dirname(os.path.abspath(__file__))
+            )
+            results[label] = json.loads(completed.stdout.strip().splitlines()[-1])
+
+    images = results["full decode"]["images"]
+    print(f"画像: {images}枚 × {args.repeat}回（{'合成画像' if not args.corpus else args.corpus}）")
+    print(f"{'':14}{'平均(ms)':>10}{'p95(ms)':>10}{'ピーク増分(MB)':>16}")
+    for label, result in results.items():
+        print(f"{label:14}{result['mean_ms']:>10.1f}{result['p95_ms']:>10.1f}{result['peak_mb']:>16.1f}")
+    before, after = results["full decode"], results["draft decode"]
+    print(f"処理時間: {before['mean_ms'] / after['mean_ms']:.2f}倍高速, "
+          f"ピークメモリ: {before['peak_mb'] - after['peak_mb']:.1f}MB 削減")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
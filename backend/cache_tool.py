@@ -0,0 +1,62 @@
+"""
+OCR結果キャッシュのJSONLインポート/エクスポート
+
+    python cache_tool.py export -o snapshot.jsonl
+    python cache_tool.py import snapshot.jsonl
+    gzip -dc history.jsonl.gz | python cache_tool.py import -
+
+キャッシュDBのパスなどの設定は main.py と同じ環境変数（.env）から読み込む
+"""
+
+import argparse
+import sys
+
+from main import (
+    CACHE_TRANSFER_CHUNK_SIZE,
+    RESULT_CACHE_DB_MAX_BYTES,
+    RESULT_CACHE_DB_PATH,
+    RESULT_CACHE_TTL,
+    DiskResultCache,
+    export_cache_jsonl,
+    import_cache_jsonl,
+)
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="OCR結果キャッシュのJSONLインポート/エクスポート")
+    parser.add_argument("--db", default=RESULT_CACHE_DB_PATH, help="キャッシュDBのパス（既定: RESULT_CACHE_DB_PATH）")
+    parser.add_argument("--chunk-size", type=int, default=CACHE_TRANSFER_CHUNK_SIZE,
+                        help="1回に読み書きする件数")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    export_parser = subparsers.add_parser("export", help="キャッシュをJSONLで書き出す")
+    export_parser.add_argument("-o", "--output", default="-", help="出力ファイル（既定: 標準出力）")
+
+    import_parser = subparsers.add_parser("import", help="JSONLをキャッシュに投入する")
+    import_parser.add_argument("input", nargs="?", default="-", help="入力ファイル（既定: 標準入力）")
+
+    args = parser.parse_args()
+    if not args.db:
+        parser.error("キャッシュDBのパスを --db か RESULT_CACHE_DB_PATH で指定してください")
+
+    cache = DiskResultCache(args.db, RESULT_CACHE_DB_MAX_BYTES, RESULT_CACHE_TTL)
+
+    if args.command == "export":
+        if args.output == "-":
+            count = export_cache_jsonl(cache, sys.stdout, args.chunk_size)
+        else:
+            with open(args.output, "w", encoding="utf-8") as out:
+                count = export_cache_jsonl(cache, out, args.chunk_size)
+        print(f"{count}件をエクスポートしました", file=sys.stderr)
+    else:
+        if args.input == "-":
+            counts = import_cache_jsonl(cache, sys.stdin, args.chunk_size)
+        else:
+            with open(args.input, encoding="utf-8") as lines:
+                counts = import_cache_jsonl(cache, lines, args.chunk_size)
+        print(f"{counts['imported']}件をインポートしました（スキップ: {counts['skipped']}件）", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
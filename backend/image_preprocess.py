@@ -0,0 +1,70 @@
+"""
+OCR前の画像最適化（縮小・JPEG再エンコード・知覚ハッシュ）
+画像最適化プールの子プロセスはこのモジュールだけを読み込むため、Pillow と NumPy 以外に依存しない
+（設定値は呼び出し側の main.py から引数で渡す）
+"""
+
+import io
+import logging
+from typing import NamedTuple, Optional
+
+import numpy as np
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+
+class PreprocessedImage(NamedTuple):
+    """前処理済み画像と、その知覚ハッシュ（計算しなかった場合は None）"""
+    data: bytes
+    fingerprint: Optional[int] = None
+
+
+def perceptual_hash(image: Image.Image, hash_size: int = 16) -> int:
+    """
+    dHash: グレースケールで (hash_size+1)×hash_size に縮小し、
+    横に隣り合う画素の明暗をビット列にした知覚ハッシュ
+    再圧縮・再保存・多少のリサイズではほとんど変化しない
+    """
+    small = image.convert('L').resize((hash_size + 1, hash_size), Image.Resampling.BOX)
+    pixels = np.asarray(small, dtype=np.int16)
+    bits = pixels[:, 1:] > pixels[:, :-1]
+    return int.from_bytes(np.packbits(bits).tobytes(), 'big')
+
+
+def preprocess_image(image_data: bytes, max_size: tuple, quality: int, jpeg_draft: bool,
+                     fingerprint_size: Optional[int] = None) -> PreprocessedImage:
+    """
+    画像を最適化してメモリ使用量を削減
+    Railway $5プランのメモリ制限(512MB)を考慮
+    fingerprint_size を指定した場合は縮小済みの画像から知覚ハッシュも計算する
+    """
+    try:
+        image = Image.open(io.BytesIO(image_data))
+
+        # 画像サイズを制限
+        if image.size[0] > max_size[0] or image.size[1] > max_size[1]:
+            original_size = image.size
+            if jpeg_draft and image.format == 'JPEG':
+                # 目標サイズを下回らない範囲で最小の 1/2・1/4・1/8 スケールでデコードする
+                # （4000×3000 なら 2000×1500 で、RGBバッファは約1/4になる）
+                scale = min(max_size[0] / image.size[0], max_size[1] / image.size[1])
+                image.draft(image.mode, (int(image.size[0] * scale), int(image.size[1] * scale)))
+            # reducing_gap: 整数倍の縮小（reduce）を先に行い、LANCZOSは最後の小さな縮小だけにする
+            image.thumbnail(max_size, Image.Resampling.LANCZOS, reducing_gap=2.0)
+            logger.info(f"画像をリサイズしました: {original_size} -> {image.size}")
+
+        # RGB形式に変換（必要に応じて）
+        if image.mode not in ['RGB', 'L']:
+            image = image.convert('RGB')
+
+        fingerprint = perceptual_hash(image, fingerprint_size) if fingerprint_size else None
+
+        # 最適化された画像をバイト形式で返す
+        output = io.BytesIO()
+        image.save(output, format='JPEG', quality=quality, optimize=True)
+        return PreprocessedImage(output.getvalue(), fingerprint)
+
+    except Exception as e:
+        logger.error(f"画像最適化エラー: {e}")
+        return PreprocessedImage(image_data)
@@ -5,41 +5,2526 @@ Railway $5プラン対応の軽量APIゲートウェイ
 
 import os
 import io
+import json
 import time
+import uuid
+import random
+import hashlib
+import hmac
+import sqlite3
+import threading
+import asyncio
+import bisect
+import contextvars
 import logging
-from typing import Optional
+import tempfile
+import sys
+import multiprocessing
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import asynccontextmanager, contextmanager, suppress
+from typing import NamedTuple, Optional
 
 from gradio_client import Client
 import requests
 import aiohttp
-from fastapi import FastAPI, UploadFile, File, HTTPException
+from fastapi import FastAPI, UploadFile, File, HTTPException, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse
 from PIL import Image
 from pydantic import BaseModel
 from dotenv import load_dotenv
 
+import image_preprocess
+from image_preprocess import PreprocessedImage
+
 # 環境変数をロード
 load_dotenv()
 
-# ロギング設定
-logging.basicConfig(level=logging.INFO)
-logger = logging.getLogger(__name__)
+# ロギング設定
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# HuggingFace Space設定
+HUGGINGFACE_SPACE_URL = os.getenv("HUGGINGFACE_SPACE_URL", "")
+# 複数レプリカ（複製したSpaceやセルフホストしたapp.py）をカンマ区切りで指定
+HUGGINGFACE_SPACE_URLS = list(dict.fromkeys(
+    url.strip().rstrip('/')
+    for url in [HUGGINGFACE_SPACE_URL, *os.getenv("HUGGINGFACE_SPACE_URLS", "").split(",")]
+    if url.strip()
+))
+HUGGINGFACE_SPACE_NAME = os.getenv("HUGGINGFACE_SPACE_NAME", "")
+HUGGINGFACE_API_NAME = os.getenv("HUGGINGFACE_API_NAME", "/predict")
+
+# HuggingFace Space接続確認
+if HUGGINGFACE_SPACE_URLS or HUGGINGFACE_SPACE_NAME:
+    logger.info(f"HuggingFace Space設定済み: {HUGGINGFACE_SPACE_NAME or ', '.join(HUGGINGFACE_SPACE_URLS)}")
+else:
+    logger.warning("HuggingFace Space設定がありません - デモモードで動作します")
+
+# gradio_client 接続プール設定
+GRADIO_CLIENT_POOL_SIZE = int(os.getenv("GRADIO_CLIENT_POOL_SIZE", "2"))
+GRADIO_CLIENT_HEALTH_CHECK_INTERVAL = float(os.getenv("GRADIO_CLIENT_HEALTH_CHECK_INTERVAL", "60"))
+# Client() の生成（Space設定の取得）を待つ上限。ビルド中・スリープ中のSpaceでは生成が終わらないため
+GRADIO_CLIENT_CONNECT_TIMEOUT = float(os.getenv("GRADIO_CLIENT_CONNECT_TIMEOUT", "30"))
+
+# 直接HTTP呼び出し用の接続プール設定
+HTTP_POOL_LIMIT = int(os.getenv("HTTP_POOL_LIMIT", "100"))
+HTTP_POOL_LIMIT_PER_HOST = int(os.getenv("HTTP_POOL_LIMIT_PER_HOST", "20"))
+HTTP_KEEPALIVE_TIMEOUT = float(os.getenv("HTTP_KEEPALIVE_TIMEOUT", "60"))
+HTTP_DNS_CACHE_TTL = int(os.getenv("HTTP_DNS_CACHE_TTL", "300"))
+
+# Space呼び出しの同時実行上限
+UPSTREAM_MAX_CONCURRENCY = int(os.getenv("UPSTREAM_MAX_CONCURRENCY", "8"))
+
+# 呼び出し方式の選択（sequential: 順に試行 / race: 同時に呼び出して先着を採用）
+UPSTREAM_STRATEGY = os.getenv("UPSTREAM_STRATEGY", "sequential").lower()
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", "3"))
+CIRCUIT_RESET_TIMEOUT = float(os.getenv("CIRCUIT_RESET_TIMEOUT", "30"))
+
+# ヘッジリクエスト（直近レイテンシの指定パーセンタイルを超えたら別経路へ複製送信）
+HEDGE_ENABLED = os.getenv("HEDGE_ENABLED", "false").lower() == "true"
+HEDGE_PERCENTILE = float(os.getenv("HEDGE_PERCENTILE", "95"))
+HEDGE_MIN_SAMPLES = int(os.getenv("HEDGE_MIN_SAMPLES", "20"))
+HEDGE_MIN_DELAY = float(os.getenv("HEDGE_MIN_DELAY", "1.0"))
+LATENCY_WINDOW_SIZE = int(os.getenv("LATENCY_WINDOW_SIZE", "500"))
+
+# 適応的タイムアウト（直近レイテンシと画像サイズから総時間の予算を決める）
+UPSTREAM_CONNECT_TIMEOUT = float(os.getenv("UPSTREAM_CONNECT_TIMEOUT", "5"))
+UPSTREAM_FIRST_BYTE_TIMEOUT = float(os.getenv("UPSTREAM_FIRST_BYTE_TIMEOUT", "20"))
+UPSTREAM_TIMEOUT_DEFAULT = float(os.getenv("UPSTREAM_TIMEOUT_DEFAULT", "60"))
+UPSTREAM_TIMEOUT_MIN = float(os.getenv("UPSTREAM_TIMEOUT_MIN", "10"))
+UPSTREAM_TIMEOUT_MAX = float(os.getenv("UPSTREAM_TIMEOUT_MAX", "180"))
+UPSTREAM_TIMEOUT_MULTIPLIER = float(os.getenv("UPSTREAM_TIMEOUT_MULTIPLIER", "3"))
+UPSTREAM_TIMEOUT_MIN_SAMPLES = int(os.getenv("UPSTREAM_TIMEOUT_MIN_SAMPLES", "20"))
+
+# Spaceのキープウォーム（スリープ防止と起動直後・アイドル後の事前ウォームアップ）
+KEEP_WARM_ENABLED = os.getenv("KEEP_WARM_ENABLED", "true").lower() == "true"
+KEEP_WARM_INTERVAL = float(os.getenv("KEEP_WARM_INTERVAL", "300"))
+KEEP_WARM_IDLE_SECONDS = float(os.getenv("KEEP_WARM_IDLE_SECONDS", "1800"))
+KEEP_WARM_TIMEOUT = float(os.getenv("KEEP_WARM_TIMEOUT", "600"))
+
+# リトライ（リトライ可能なエラーのみ、グローバルな予算内で実施）
+UPSTREAM_MAX_RETRIES = int(os.getenv("UPSTREAM_MAX_RETRIES", "2"))
+RETRY_BACKOFF_BASE = float(os.getenv("RETRY_BACKOFF_BASE", "0.5"))
+RETRY_BACKOFF_MAX = float(os.getenv("RETRY_BACKOFF_MAX", "8"))
+RETRY_BUDGET_RATIO = float(os.getenv("RETRY_BUDGET_RATIO", "0.1"))
+RETRY_BUDGET_MIN_PER_SECOND = float(os.getenv("RETRY_BUDGET_MIN_PER_SECOND", "0.2"))
+RETRY_BUDGET_MAX_TOKENS = float(os.getenv("RETRY_BUDGET_MAX_TOKENS", "10"))
+# モデル処理エラーは同じ画像で再発しやすく、再試行はGPU処理を増やすだけなので既定ではリトライしない
+UPSTREAM_RETRY_SOFT_ERRORS = os.getenv("UPSTREAM_RETRY_SOFT_ERRORS", "false").lower() == "true"
+
+# クライアント切断の監視間隔（秒）
+DISCONNECT_POLL_INTERVAL = float(os.getenv("DISCONNECT_POLL_INTERVAL", "0.5"))
+
+# OCR結果キャッシュ（画像内容のハッシュ＋OCRオプションをキーとするLRU/TTL）
+RESULT_CACHE_ENABLED = os.getenv("RESULT_CACHE_ENABLED", "true").lower() == "true"
+RESULT_CACHE_MAX_BYTES = int(os.getenv("RESULT_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+RESULT_CACHE_TTL = float(os.getenv("RESULT_CACHE_TTL", str(7 * 24 * 3600)))
+# ディスク永続キャッシュ（SQLite WAL）。再デプロイ後も残すにはRailwayのボリューム上を指定する
+# 空文字で無効化
+RESULT_CACHE_DB_PATH = os.getenv("RESULT_CACHE_DB_PATH", "ocr_cache.sqlite3")
+RESULT_CACHE_DB_MAX_BYTES = int(os.getenv("RESULT_CACHE_DB_MAX_BYTES", str(256 * 1024 * 1024)))
+# 元ファイルのSHA-256 → 結果キャッシュキーの対応表（ハッシュ先行の問い合わせAPI用）
+# 全件はSQLiteの raw_digests に置き、メモリには直近に使った分だけを置く（ワーカー間で分け合う）
+RAW_DIGEST_INDEX_MAX_ENTRIES = int(os.getenv("RAW_DIGEST_INDEX_MAX_ENTRIES", "200000"))
+RAW_DIGEST_MEMORY_MAX_BYTES = int(os.getenv("RAW_DIGEST_MEMORY_MAX_BYTES", str(8 * 1024 * 1024)))
+# 知覚ハッシュ（dHash）による再エンコード画像の近似一致検索
+PHASH_ENABLED = os.getenv("PHASH_ENABLED", "false").lower() == "true"
+PHASH_HASH_SIZE = int(os.getenv("PHASH_HASH_SIZE", "16"))
+PHASH_MAX_DISTANCE = int(os.getenv("PHASH_MAX_DISTANCE", "8"))
+# 索引の件数上限（全ワーカー合計。ワーカー数で割って使う）
+PHASH_INDEX_MAX_ENTRIES = int(os.getenv("PHASH_INDEX_MAX_ENTRIES", "100000"))
+# キャッシュのJSONLインポート/エクスポートで1回に読み書きする件数
+CACHE_TRANSFER_CHUNK_SIZE = int(os.getenv("CACHE_TRANSFER_CHUNK_SIZE", "1000"))
+# 管理API（/api/v1/admin/...）のトークン。未設定なら管理APIは無効
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
+
+# 複数ゲートウェイ間の分散キャッシュ（コンシステントハッシュでキーの担当ノードを決める）
+# CACHE_PEERS に自分を含む全ノードのURL、CACHE_SELF_URL に自分のURLを指定する
+CACHE_PEERS = [url.strip().rstrip("/") for url in os.getenv("CACHE_PEERS", "").split(",") if url.strip()]
+CACHE_SELF_URL = os.getenv("CACHE_SELF_URL", "").strip().rstrip("/")
+CACHE_PEER_VNODES = int(os.getenv("CACHE_PEER_VNODES", "100"))
+CACHE_PEER_TIMEOUT = float(os.getenv("CACHE_PEER_TIMEOUT", "300"))
+# ノード間の内部APIの共有トークン（CACHE_PEERS を設定する場合は必須）
+CACHE_PEER_TOKEN = os.getenv("CACHE_PEER_TOKEN", "")
+
+# アップロード画像のサイズ上限（ノード間の内部APIにも同じ上限を適用する）
+MAX_UPLOAD_BYTES = 10 * 1024 * 1024
+
+# キャッシュの名前空間（モデル・前処理設定が変わると別のキーになる）
+OCR_MODEL_ID = os.getenv("OCR_MODEL_ID", "ucaslcl/GOT-OCR2_0")
+OCR_MODEL_REVISION = os.getenv("OCR_MODEL_REVISION", "main")
+OCR_TYPE = os.getenv("OCR_TYPE", "ocr")
+PREPROCESS_MAX_SIZE = int(os.getenv("PREPROCESS_MAX_SIZE", "1920"))
+PREPROCESS_JPEG_QUALITY = int(os.getenv("PREPROCESS_JPEG_QUALITY", "85"))
+# 大きなJPEGをDCT領域で縮小しながらデコードする（Image.draft）。フル解像度のバッファを確保しない
+PREPROCESS_JPEG_DRAFT = os.getenv("PREPROCESS_JPEG_DRAFT", "true").lower() == "true"
+# 画像最適化（Pillow）の実行先: process（プロセスプール）/ thread（スレッドプール）/ inline（イベントループ上）
+PREPROCESS_EXECUTOR = os.getenv("PREPROCESS_EXECUTOR", "process").lower()
+PREPROCESS_WORKERS = int(os.getenv("PREPROCESS_WORKERS", "0"))  # 0ならCPU数とメモリ予算から決める
+# プロセスプールの子プロセス1つあたりのメモリ見積もり（Pillow・NumPyの読み込み＋1枚分のデコード）
+PREPROCESS_CHILD_MEMORY_MB = int(os.getenv("PREPROCESS_CHILD_MEMORY_MB", "64"))
+PREPROCESS_MAX_QUEUE = int(os.getenv("PREPROCESS_MAX_QUEUE", "32"))  # 実行中＋待機中の上限（超えたら503）
+PREPROCESS_TIMEOUT = float(os.getenv("PREPROCESS_TIMEOUT", "30"))
+# 旧名前空間の結果を stale フラグ付きで返し、バックグラウンドで新しいモデルで再計算する
+STALE_SERVE_ENABLED = os.getenv("STALE_SERVE_ENABLED", "true").lower() == "true"
+REWARM_RATE_PER_MINUTE = float(os.getenv("REWARM_RATE_PER_MINUTE", "30"))
+# 再計算待ち（最適化済み画像）の合計サイズ上限。1枚あたり数百KB〜1.5MB程度
+REWARM_QUEUE_MAX_BYTES = int(os.getenv("REWARM_QUEUE_MAX_BYTES", str(16 * 1024 * 1024)))
+
+# レプリカの負荷分散と受動的ヘルスチェック
+REPLICA_BALANCING = os.getenv("REPLICA_BALANCING", "least_outstanding").lower()
+REPLICA_EWMA_ALPHA = float(os.getenv("REPLICA_EWMA_ALPHA", "0.3"))
+REPLICA_EJECT_FAILURES = int(os.getenv("REPLICA_EJECT_FAILURES", "3"))
+REPLICA_EJECT_SECONDS = float(os.getenv("REPLICA_EJECT_SECONDS", "30"))
+REPLICA_EJECT_MAX_SECONDS = float(os.getenv("REPLICA_EJECT_MAX_SECONDS", "300"))
+
+# マルチワーカー起動（python main.py）。WEB_CONCURRENCY 未指定ならCPU数とメモリ予算から決める
+WEB_CONCURRENCY = int(os.getenv("WEB_CONCURRENCY", "0"))
+MEMORY_BUDGET_MB = int(os.getenv("MEMORY_BUDGET_MB", "0"))  # 0ならcgroupの上限（無ければ物理メモリ）
+WORKER_MEMORY_MB = int(os.getenv("WORKER_MEMORY_MB", "192"))
+# 起動側が各ワーカーに渡すワーカー数。上流の同時実行数とメモリキャッシュをワーカー間で分け合う
+GATEWAY_WORKERS = max(1, int(os.getenv("GATEWAY_WORKERS", "1")))
+# ワーカー間で集計するメトリクスの置き場所（SQLite WAL）。空なら集計しない
+METRICS_DB_PATH = os.getenv("METRICS_DB_PATH", "")
+METRICS_FLUSH_INTERVAL = float(os.getenv("METRICS_FLUSH_INTERVAL", "5"))
+# キープウォームを動かすワーカーのリース期間（同じSQLiteで1ワーカーだけが保持する）
+LEADER_LEASE_SECONDS = float(os.getenv("LEADER_LEASE_SECONDS", "30"))
+
+
+# ゲートウェイ全体のカウンタ（/api/v1/status で公開）
+METRICS: Counter = Counter()
+
+
+class SharedMetrics:
+    """
+    ワーカーごとのカウンタを同じホストのSQLite（WAL）に書き出し、全ワーカーの合計を返す
+    カウンタは累積値なので、終了・再起動したワーカーの最後の値も合計に含める
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.worker_id = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self._lock = threading.Lock()
+        self._conn: Optional[sqlite3.Connection] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, timeout=5.0, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=OFF")
+            conn.execute("PRAGMA busy_timeout=5000")
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS worker_metrics (
+                    worker_id TEXT NOT NULL,
+                    name TEXT NOT NULL,
+                    value REAL NOT NULL,
+                    updated_at REAL NOT NULL,
+                    PRIMARY KEY (worker_id, name)
+                )
+                """
+            )
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS worker_leases (
+                    name TEXT PRIMARY KEY,
+                    worker_id TEXT NOT NULL,
+                    expires_at REAL NOT NULL
+                )
+                """
+            )
+            self._conn = conn
+        return self._conn
+
+    def _flush(self, snapshot: dict) -> None:
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            conn.executemany(
+                "INSERT OR REPLACE INTO worker_metrics (worker_id, name, value, updated_at) VALUES (?, ?, ?, ?)",
+                [(self.worker_id, name, value, now) for name, value in snapshot.items()]
+            )
+
+    def _totals(self) -> tuple:
+        with self._lock:
+            conn = self._connect()
+            totals = dict(conn.execute("SELECT name, SUM(value) FROM worker_metrics GROUP BY name"))
+            workers = conn.execute(
+                "SELECT worker_id, MAX(updated_at) FROM worker_metrics GROUP BY worker_id"
+            ).fetchall()
+        return totals, workers
+
+    def _acquire_lease(self, name: str, ttl: float) -> bool:
+        """自ワーカーが保持中か期限切れならリースを取得・延長し、保持しているかを返す"""
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            conn.execute(
+                """
+                INSERT INTO worker_leases (name, worker_id, expires_at) VALUES (?, ?, ?)
+                ON CONFLICT(name) DO UPDATE SET worker_id = excluded.worker_id, expires_at = excluded.expires_at
+                WHERE worker_leases.worker_id = excluded.worker_id OR worker_leases.expires_at < ?
+                """,
+                (name, self.worker_id, now + ttl, now)
+            )
+            row = conn.execute("SELECT worker_id FROM worker_leases WHERE name = ?", (name,)).fetchone()
+        return row is not None and row[0] == self.worker_id
+
+    def _release_lease(self, name: str) -> None:
+        with self._lock:
+            self._connect().execute(
+                "DELETE FROM worker_leases WHERE name = ? AND worker_id = ?", (name, self.worker_id)
+            )
+
+    async def acquire_lease(self, name: str, ttl: float) -> bool:
+        try:
+            return await asyncio.to_thread(self._acquire_lease, name, ttl)
+        except sqlite3.Error as e:
+            logger.warning(f"リース更新エラー: {e}")
+            return False
+
+    async def release_lease(self, name: str) -> None:
+        try:
+            await asyncio.to_thread(self._release_lease, name)
+        except sqlite3.Error as e:
+            logger.warning(f"リース解放エラー: {e}")
+
+    async def flush(self) -> None:
+        try:
+            await asyncio.to_thread(self._flush, dict(METRICS))
+        except sqlite3.Error as e:
+            logger.warning(f"メトリクス書き込みエラー: {e}")
+
+    async def totals(self) -> Optional[dict]:
+        """自ワーカーの最新値を書き出してから全ワーカーの合計を返す"""
+        await self.flush()
+        try:
+            totals, workers = await asyncio.to_thread(self._totals)
+        except sqlite3.Error as e:
+            logger.warning(f"メトリクス読み込みエラー: {e}")
+            return None
+        now = time.time()
+        return {
+            "metrics": totals,
+            "workers": len(workers),
+            # 直近に書き出したワーカー（終了したワーカーは合計には含まれるがここには数えない）
+            "active_workers": sum(1 for _, updated_at in workers if now - updated_at <= 3 * METRICS_FLUSH_INTERVAL),
+        }
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(METRICS_FLUSH_INTERVAL)
+            await self.flush()
+
+
+class LeaderService:
+    """
+    start()/stop() を持つバックグラウンド処理を、全ワーカーのうちリースを持つ1つだけで動かす
+    リースは期間の1/3ごとに更新し、更新できなくなったら止める
+    保持していたワーカーが終了すると、期限切れ後に別のワーカーが引き継ぐ
+    """
+
+    def __init__(self, name: str, service, metrics: SharedMetrics, ttl: float):
+        self.name = name
+        self.service = service
+        self.metrics = metrics
+        self.ttl = ttl
+        self.leader = False
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self.leader:
+            self.leader = False
+            await self.service.stop()
+            await self.metrics.release_lease(self.name)
+
+    async def _run(self) -> None:
+        while True:
+            held = await self.metrics.acquire_lease(self.name, self.ttl)
+            if held and not self.leader:
+                logger.info(f"{self.name} をこのワーカーで実行します ({self.metrics.worker_id})")
+                self.leader = True
+                self.service.start()
+            elif not held and self.leader:
+                logger.info(f"{self.name} のリースを失いました - 停止します")
+                self.leader = False
+                await self.service.stop()
+            await asyncio.sleep(self.ttl / 3)
+
+
+class LatencyTracker:
+    """直近N件のレイテンシ（と画像のピクセル数）を保持し、パーセンタイルを返す"""
+
+    def __init__(self, window_size: int = 500):
+        self._samples: deque = deque(maxlen=max(1, window_size))
+        self._pixels: deque = deque(maxlen=max(1, window_size))
+
+    def record(self, latency: float, pixels: Optional[int] = None) -> None:
+        self._samples.append(latency)
+        if pixels:
+            self._pixels.append(pixels)
+
+    def median_pixels(self) -> Optional[int]:
+        if not self._pixels:
+            return None
+        ordered = sorted(self._pixels)
+        return ordered[len(ordered) // 2]
+
+    def __len__(self) -> int:
+        return len(self._samples)
+
+    def percentile(self, percentile: float) -> Optional[float]:
+        if not self._samples:
+            return None
+        ordered = sorted(self._samples)
+        index = min(len(ordered) - 1, max(0, round(percentile / 100 * (len(ordered) - 1))))
+        return ordered[index]
+
+    def stats(self) -> dict:
+        return {
+            "samples": len(self._samples),
+            "p50": self.percentile(50),
+            "p95": self.percentile(95),
+            "p99": self.percentile(99),
+        }
+
+
+class RetryBudget:
+    """
+    リトライ予算（トークンバケット）
+    リクエスト1件ごとに ratio 分のトークンが貯まり、リトライ1回で1トークン消費する
+    障害時にリトライが負荷を増幅しないよう、リトライ率を全体の ratio 程度に抑える
+    """
+
+    def __init__(self, ratio: float, min_per_second: float, max_tokens: float):
+        self.ratio = ratio
+        self.min_per_second = min_per_second
+        self.max_tokens = max_tokens
+        self.tokens = max_tokens
+        self._refilled_at = time.monotonic()
+        self.exhausted = 0
+
+    def _refill(self) -> None:
+        # 低トラフィック時でも最低限のリトライができるよう時間でも補充する
+        now = time.monotonic()
+        self.tokens = min(self.max_tokens, self.tokens + (now - self._refilled_at) * self.min_per_second)
+        self._refilled_at = now
+
+    def record_request(self) -> None:
+        self._refill()
+        self.tokens = min(self.max_tokens, self.tokens + self.ratio)
+
+    def try_spend(self) -> bool:
+        self._refill()
+        if self.tokens >= 1.0:
+            self.tokens -= 1.0
+            return True
+        self.exhausted += 1
+        return False
+
+    def stats(self) -> dict:
+        self._refill()
+        return {
+            "tokens": round(self.tokens, 2),
+            "max_tokens": self.max_tokens,
+            "ratio": self.ratio,
+            "exhausted": self.exhausted,
+        }
+
+
+class UpstreamBudget(NamedTuple):
+    """1回の上流呼び出しに与える時間予算（秒）"""
+    connect: float
+    first_byte: float
+    total: float
+
+    def client_timeout(self) -> aiohttp.ClientTimeout:
+        """aiohttpの各リクエスト用（総時間は呼び出し全体で別途管理）"""
+        return aiohttp.ClientTimeout(total=None, sock_connect=self.connect, sock_read=self.first_byte)
+
+
+class GradioClientPool:
+    """
+    gradio_client.Client の長寿命プール
+    Space設定・APIスキーマの取得は接続時の1回だけにし、
+    リクエストごとの接続コストを predict 本体のみに抑える
+    Clientはスレッドセーフに submit できるため、借り出しは排他にせず
+    処理中リクエスト数が最も少ない接続に振り分ける
+    """
+
+    # 接続を作り直すべき失敗の型名（gradio_client が内部で使う httpx / websockets の例外）
+    CONNECTION_ERRORS = {
+        "ConnectError", "ConnectTimeout", "ReadError", "WriteError", "NetworkError",
+        "RemoteProtocolError", "ConnectionClosed", "InvalidHandshake", "InvalidURI",
+    }
+
+    def __init__(self, space_name: str, size: int = 2, health_check_interval: float = 60.0,
+                 max_workers: int = 8, connect_timeout: float = 30.0):
+        self.space_name = space_name
+        self.size = max(1, size)
+        self.health_check_interval = health_check_interval
+        self.max_workers = max_workers
+        self.connect_timeout = connect_timeout
+        # None は「未接続または破棄済み」のスロットを表す
+        self._clients: list = [None] * self.size
+        # 生成中の Client()（スレッドは中断できないため、待ちが打ち切られても次の待ち手が引き継ぐ）
+        self._connecting: list = [None] * self.size
+        self._in_flight = [0] * self.size
+        self._last_used = [0.0] * self.size
+        self._locks = [asyncio.Lock() for _ in range(self.size)]
+        self._preconnect_task: Optional[asyncio.Task] = None
+        self.created = 0
+        self.reconnects = 0
+        self.health_check_failures = 0
+        self.connect_timeouts = 0
+        self.retired = 0
+
+    def start(self) -> None:
+        """
+        バックグラウンドで事前接続を始める
+        Spaceがビルド中・スリープ中だと接続が終わらないため、起動処理はこれを待たない
+        """
+        if self._preconnect_task is None:
+            self._preconnect_task = asyncio.create_task(self._preconnect())
+
+    async def _preconnect(self) -> None:
+        for index in range(self.size):
+            try:
+                async with self._locks[index]:
+                    if self._clients[index] is None:
+                        self._clients[index] = await self._connect(index)
+                        self._last_used[index] = time.monotonic()
+            except Exception as e:
+                # 初回利用時に再接続する
+                logger.warning(f"Gradio Client 事前接続に失敗しました: {e}")
+
+    async def close(self) -> None:
+        """プール内の接続をすべて破棄する"""
+        if self._preconnect_task is not None:
+            self._preconnect_task.cancel()
+            try:
+                await self._preconnect_task
+            except asyncio.CancelledError:
+                pass
+            self._preconnect_task = None
+        for index in range(self.size):
+            client = self._clients[index]
+            self._clients[index] = None
+            if client is not None:
+                client.executor.shutdown(wait=False, cancel_futures=True)
+            connecting = self._connecting[index]
+            self._connecting[index] = None
+            if connecting is not None:
+                # 生成中の接続は完了した時点で破棄する
+                connecting.add_done_callback(self._discard_connecting)
+
+    def _start_connect(self) -> asyncio.Future:
+        """
+        Client() をデーモンスレッドで生成する
+        終わらない生成が既定のスレッドプールに残ると、終了時にその完了を待ってプロセスが止まらないため
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def deliver(client: Optional[Client], error: Optional[BaseException]) -> None:
+            if future.done():
+                if client is not None:
+                    client.executor.shutdown(wait=False, cancel_futures=True)
+            elif error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(client)
+
+        def run() -> None:
+            client, error = None, None
+            try:
+                client = self._create_client()
+            except Exception as e:
+                error = e
+            try:
+                loop.call_soon_threadsafe(deliver, client, error)
+            except RuntimeError:
+                # イベントループ終了後に生成が終わった
+                pass
+
+        threading.Thread(target=run, name="gradio-client-connect", daemon=True).start()
+        return future
+
+    @staticmethod
+    def _discard_connecting(task: asyncio.Future) -> None:
+        if not task.cancelled() and task.exception() is None:
+            task.result().executor.shutdown(wait=False, cancel_futures=True)
+
+    async def _connect(self, index: int) -> Client:
+        """
+        スロットの Client() を生成する（connect_timeout 秒で待ちを打ち切る）
+        打ち切っても生成は続け、次回の呼び出しは同じ生成の完了を待つ
+        """
+        task = self._connecting[index]
+        if task is None:
+            task = self._connecting[index] = self._start_connect()
+        try:
+            return await asyncio.wait_for(asyncio.shield(task), self.connect_timeout)
+        except asyncio.TimeoutError:
+            self.connect_timeouts += 1
+            raise UpstreamError(
+                f"Gradio Client の接続が{self.connect_timeout:.0f}秒以内に完了しませんでした", UpstreamError.TIMEOUT
+            )
+        finally:
+            if task.done() and self._connecting[index] is task:
+                self._connecting[index] = None
+
+    def _create_client(self) -> Client:
+        client = Client(self.space_name, verbose=False, max_workers=self.max_workers)
+        self.created += 1
+        logger.info(f"Gradio Client 接続完了: {self.space_name}")
+        return client
+
+    @staticmethod
+    def _ping(client: Client) -> bool:
+        try:
+            response = requests.get(f"{client.src.rstrip('/')}/config", timeout=5)
+            return response.status_code == 200
+        except Exception:
+            return False
+
+    async def _ensure_client(self, index: int) -> Client:
+        """スロットの接続を返す（一定時間アイドルなら疎通確認し、必要に応じて再接続）"""
+        async with self._locks[index]:
+            client = self._clients[index]
+            idle = time.monotonic() - self._last_used[index]
+            if client is not None and idle >= self.health_check_interval:
+                if not await asyncio.to_thread(self._ping, client):
+                    logger.warning("Gradio Client ヘルスチェック失敗 - 再接続します")
+                    self.health_check_failures += 1
+                    client = self._clients[index] = None
+            if client is None:
+                client = await self._connect(index)
+                self._clients[index] = client
+                self.reconnects += 1
+            return client
+
+    def retire(self, client: Client) -> None:
+        """
+        打ち切ったジョブがまだ実行中の接続を手放す
+        gradio_client のSSE受信はタイムアウト無しで、Spaceが応答しないとスレッドが戻らない
+        その接続の実行スレッドが塞がったまま後続のジョブが詰まらないよう、次回利用時に作り直す
+        """
+        for index in range(self.size):
+            if self._clients[index] is client:
+                self._clients[index] = None
+                self.retired += 1
+        # 待機中のジョブは実行させ、全スレッドが戻った時点で実行器を片付ける
+        client.executor.shutdown(wait=False)
+
+    @classmethod
+    def is_connection_error(cls, error: Exception) -> bool:
+        """
+        接続そのものが壊れた失敗か
+        タイムアウトやSpace側の処理エラー・キュー満杯は接続が健全なまま起きるため含めない
+        """
+        if isinstance(error, requests.exceptions.ConnectionError):
+            return True
+        if isinstance(error, (TimeoutError, requests.exceptions.Timeout)):
+            return False
+        if isinstance(error, OSError):
+            return True
+        return any(t.__name__ in cls.CONNECTION_ERRORS for t in type(error).__mro__)
+
+    @asynccontextmanager
+    async def acquire(self):
+        """
+        接続を1つ借り出す
+        利用中に接続レベルの失敗が起きた接続は破棄され、次回利用時に再構築される
+        """
+        index = min(range(self.size), key=lambda i: self._in_flight[i])
+        self._in_flight[index] += 1
+        try:
+            client = await self._ensure_client(index)
+            try:
+                yield client
+            except Exception as e:
+                if self.is_connection_error(e) and self._clients[index] is client:
+                    self._clients[index] = None
+                raise
+        finally:
+            self._in_flight[index] -= 1
+            self._last_used[index] = time.monotonic()
+
+    def stats(self) -> dict:
+        return {
+            "size": self.size,
+            "connected": sum(1 for client in self._clients if client is not None),
+            "in_flight": sum(self._in_flight),
+            "created": self.created,
+            "reconnects": self.reconnects,
+            "health_check_failures": self.health_check_failures,
+            "connect_timeouts": self.connect_timeouts,
+            "retired": self.retired,
+        }
+
+
+class UpstreamLimiter:
+    """Spaceへの同時呼び出し数の上限管理"""
+
+    def __init__(self, limit: int):
+        self.limit = max(1, limit)
+        self._semaphore = asyncio.Semaphore(self.limit)
+        self.in_flight = 0
+        self.waiting = 0
+
+    @asynccontextmanager
+    async def slot(self):
+        self.waiting += 1
+        try:
+            await self._semaphore.acquire()
+        finally:
+            self.waiting -= 1
+        self.in_flight += 1
+        try:
+            yield
+        finally:
+            self.in_flight -= 1
+            self._semaphore.release()
+
+    def stats(self) -> dict:
+        return {
+            "limit": self.limit,
+            "in_flight": self.in_flight,
+            "waiting": self.waiting,
+        }
+
+
+class UpstreamError(Exception):
+    """
+    分類済みの上流呼び出しエラー
+    kind によってリトライ可否を判断する
+    """
+
+    TRANSPORT = "transport"        # 接続・HTTPレベルの失敗
+    QUEUE_FULL = "queue_full"      # Spaceのキューが満杯
+    SOFT_ERROR = "soft_error"      # Spaceは応答したがモデル処理が失敗（model_used: "error"）
+    TIMEOUT = "timeout"            # 時間予算の超過
+    CIRCUIT_OPEN = "circuit_open"  # 全方式のサーキットが開いている
+
+    RETRYABLE = {TRANSPORT, QUEUE_FULL, TIMEOUT}
+
+    def __init__(self, message: str, kind: str = TRANSPORT):
+        super().__init__(message)
+        self.kind = kind
+
+    @property
+    def retryable(self) -> bool:
+        if self.kind == self.SOFT_ERROR:
+            return UPSTREAM_RETRY_SOFT_ERRORS
+        return self.kind in self.RETRYABLE
+
+
+class GradioQueueError(UpstreamError):
+    """Gradioキュープロトコルでのエラー"""
+
+    def __init__(self, message: str, kind: str = UpstreamError.TRANSPORT):
+        super().__init__(message, kind)
+
+
+# SSEの1行の上限。長い文書のOCR結果は1行のJSONになり、日本語のエスケープで数百KBを超えることがある
+SSE_MAX_LINE_BYTES = 64 * 1024 * 1024
+
+
+async def iter_sse_lines(content: aiohttp.StreamReader):
+    """
+    SSEストリームを行単位で返す
+    aiohttp の行読み（async for line in content）はバッファ上限（約128KiB）を超える行で
+    ValueError("Chunk too big") を送出するため、受信したチャンクを自前で行に分割する
+    """
+    buffer = bytearray()
+    async for chunk in content.iter_any():
+        buffer.extend(chunk)
+        start = 0
+        while True:
+            end = buffer.find(b"\n", start)
+            if end < 0:
+                break
+            yield bytes(buffer[start:end + 1])
+            start = end + 1
+        del buffer[:start]
+        if len(buffer) > SSE_MAX_LINE_BYTES:
+            raise GradioQueueError(f"SSEの1行が上限（{SSE_MAX_LINE_BYTES}バイト）を超えました")
+    if buffer:
+        yield bytes(buffer)
+
+
+class GradioQueueClient:
+    """
+    aiohttp のみで Gradio 4 のキュープロトコルを話す非同期クライアント
+    POST /queue/join でジョブを投入して event_id を受け取り、
+    GET /queue/data のSSEストリームで process_starts / process_completed を待つ
+    """
+
+    def __init__(self, base_url: str, api_name: str = "/predict"):
+        self.base_url = base_url.rstrip('/')
+        self.api_name = api_name
+        self._fn_index: Optional[int] = None
+        self._trigger_id: Optional[int] = None
+        self.calls = 0
+        self.failures = 0
+        self.queue_full = 0
+        self.cancelled = 0
+        self._background_tasks: set = set()
+        self.last_queue_rank: Optional[int] = None
+        self._phase_totals = {"upload": 0.0, "submit": 0.0, "queue_wait": 0.0, "processing": 0.0}
+        self._phase_count = 0
+
+    async def _resolve_endpoint(self, session: aiohttp.ClientSession) -> int:
+        """/config から api_name に対応する fn_index を解決（結果はキャッシュ）"""
+        if self._fn_index is not None:
+            return self._fn_index
+
+        async with session.get(
+            f"{self.base_url}/config",
+            timeout=aiohttp.ClientTimeout(total=10)
+        ) as response:
+            if response.status != 200:
+                raise GradioQueueError(f"Space設定の取得に失敗しました: HTTP {response.status}")
+            config = await response.json()
+
+        api_name = self.api_name.lstrip('/')
+        for fn_index, dependency in enumerate(config.get("dependencies", [])):
+            if dependency.get("api_name") == api_name:
+                self._fn_index = dependency.get("id", fn_index)
+                targets = dependency.get("targets") or []
+                if targets and isinstance(targets[0], (list, tuple)):
+                    self._trigger_id = targets[0][0]
+                return self._fn_index
+
+        raise GradioQueueError(f"APIエンドポイントが見つかりません: {self.api_name}")
+
+    async def upload(self, session: aiohttp.ClientSession, file_data: bytes,
+                     filename: str = "uploaded_image.jpg", mime_type: str = "image/jpeg",
+                     timeout: Optional[aiohttp.ClientTimeout] = None) -> dict:
+        """
+        画像バイト列を /upload へマルチパートで送信し、predict 用の FileData を返す
+        base64 化しないため、ペイロードの膨張と文字列コピーが発生しない
+        """
+        started_at = time.monotonic()
+        form = aiohttp.FormData()
+        form.add_field("files", file_data, filename=filename, content_type=mime_type)
+
+        async with session.post(
+            f"{self.base_url}/upload",
+            data=form,
+            timeout=timeout or aiohttp.ClientTimeout(total=60)
+        ) as response:
+            if response.status != 200:
+                raise GradioQueueError(f"画像アップロードエラー: HTTP {response.status}")
+            paths = await response.json()
+
+        if not paths:
+            raise GradioQueueError("画像アップロードの応答が空です")
+        self._phase_totals["upload"] += time.monotonic() - started_at
+
+        return {
+            "path": paths[0],
+            "orig_name": filename,
+            "size": len(file_data),
+            "mime_type": mime_type,
+            "meta": {"_type": "gradio.FileData"}
+        }
+
+    async def predict(self, session: aiohttp.ClientSession, data: list,
+                      timeout: Optional[aiohttp.ClientTimeout] = None) -> list:
+        """
+        ジョブを投入し、完了イベントの出力データを返す
+        heartbeat は読み飛ばし、estimation でキュー位置を記録する
+        """
+        self.calls += 1
+        try:
+            fn_index = await self._resolve_endpoint(session)
+            session_hash = uuid.uuid4().hex
+            submitted_at = time.monotonic()
+
+            async with session.post(
+                f"{self.base_url}/queue/join",
+                json={
+                    "data": data,
+                    "event_data": None,
+                    "fn_index": fn_index,
+                    "trigger_id": self._trigger_id,
+                    "session_hash": session_hash,
+                },
+                timeout=timeout or aiohttp.ClientTimeout(total=60)
+            ) as response:
+                if response.status == 503:
+                    self.queue_full += 1
+                    raise GradioQueueError("Spaceのキューが満杯です", UpstreamError.QUEUE_FULL)
+                if response.status != 200:
+                    raise GradioQueueError(f"ジョブ投入エラー: HTTP {response.status}")
+                event_id = (await response.json()).get("event_id")
+
+            try:
+                return await self._stream_result(session, session_hash, event_id, submitted_at, timeout)
+            except asyncio.CancelledError:
+                # 呼び出し元がキャンセルされたらSpace側のジョブも取り消し、GPUキューの枠を空ける
+                self._cancel_in_background(session, session_hash, fn_index, event_id)
+                raise
+
+        except Exception:
+            self.failures += 1
+            # Spaceの再ビルドで fn_index が変わる可能性があるため再解決させる
+            self._fn_index = None
+            raise
+
+    async def _stream_result(self, session: aiohttp.ClientSession, session_hash: str,
+                             event_id: Optional[str], submitted_at: float,
+                             timeout: Optional[aiohttp.ClientTimeout]) -> list:
+        """SSEストリームを読み、完了イベントの出力データを返す"""
+        phases = {}
+        joined_at = time.monotonic()
+        phases["submit"] = joined_at - submitted_at
+        started_at = joined_at
+
+        async with session.get(
+            f"{self.base_url}/queue/data",
+            params={"session_hash": session_hash},
+            headers={"Accept": "text/event-stream"},
+            timeout=timeout or aiohttp.ClientTimeout(total=60)
+        ) as response:
+            if response.status != 200:
+                raise GradioQueueError(f"イベントストリーム接続エラー: HTTP {response.status}")
+
+            async for raw_line in iter_sse_lines(response.content):
+                line = raw_line.decode("utf-8").strip()
+                if not line.startswith("data:"):
+                    continue
+                message = json.loads(line[5:])
+                if message.get("event_id") not in (None, event_id):
+                    continue
+
+                msg = message.get("msg")
+                if msg == "heartbeat":
+                    continue
+                elif msg == "estimation":
+                    self.last_queue_rank = message.get("rank")
+                elif msg == "queue_full":
+                    self.queue_full += 1
+                    raise GradioQueueError("Spaceのキューが満杯です", UpstreamError.QUEUE_FULL)
+                elif msg == "process_starts":
+                    started_at = time.monotonic()
+                    phases["queue_wait"] = started_at - joined_at
+                elif msg == "process_completed":
+                    phases.setdefault("queue_wait", started_at - joined_at)
+                    phases["processing"] = time.monotonic() - started_at
+                    self._record_phases(phases)
+                    output = message.get("output") or {}
+                    if not message.get("success", True) or output.get("error"):
+                        raise GradioQueueError(
+                            f"Space処理エラー: {output.get('error')}", UpstreamError.SOFT_ERROR
+                        )
+                    return output.get("data") or []
+                elif msg == "unexpected_error":
+                    raise GradioQueueError(f"Space内部エラー: {message.get('message')}")
+                elif msg == "close_stream":
+                    break
+
+        raise GradioQueueError("完了イベントを受信する前にストリームが終了しました")
+
+
+    def _cancel_in_background(self, session: aiohttp.ClientSession, session_hash: str,
+                              fn_index: int, event_id: Optional[str]) -> None:
+        """キャンセル処理中でも確実に送れるよう、/reset を別タスクで送信する"""
+        task = asyncio.create_task(self.cancel(session, session_hash, fn_index, event_id))
+        self._background_tasks.add(task)
+        task.add_done_callback(self._background_tasks.discard)
+
+    async def cancel(self, session: aiohttp.ClientSession, session_hash: str,
+                     fn_index: int, event_id: Optional[str]) -> None:
+        """Space側のジョブを取り消す（キュー待ちのジョブはキューから外される）"""
+        self.cancelled += 1
+        try:
+            async with session.post(
+                f"{self.base_url}/reset",
+                json={"session_hash": session_hash, "fn_index": fn_index, "event_id": event_id},
+                timeout=aiohttp.ClientTimeout(total=5)
+            ) as response:
+                if response.status != 200:
+                    logger.warning(f"ジョブ取り消しに失敗しました: HTTP {response.status}")
+        except Exception as e:
+            logger.warning(f"ジョブ取り消しに失敗しました: {e}")
+
+    def _record_phases(self, phases: dict) -> None:
+        self._phase_count += 1
+        for name, value in phases.items():
+            self._phase_totals[name] += value
+        logger.info(
+            "Gradioキュー処理: "
+            + ", ".join(f"{name}={value:.2f}秒" for name, value in phases.items())
+        )
+
+    def stats(self) -> dict:
+        count = self._phase_count or 1
+        return {
+            "calls": self.calls,
+            "failures": self.failures,
+            "queue_full": self.queue_full,
+            "cancelled": self.cancelled,
+            "last_queue_rank": self.last_queue_rank,
+            "avg_phase_seconds": {
+                name: round(total / count, 3) for name, total in self._phase_totals.items()
+            },
+        }
+
+
+class CircuitBreaker:
+    """
+    呼び出し方式ごとのサーキットブレーカー
+    連続失敗で open になり、一定時間後に half_open で1件だけ試験的に通す
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, name: str, failure_threshold: int = 3, reset_timeout: float = 30.0):
+        self.name = name
+        self.failure_threshold = max(1, failure_threshold)
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self._probe_in_flight = False
+        self.successes = 0
+        self.failures = 0
+        self.rejected = 0
+
+    def allow_request(self) -> bool:
+        """呼び出してよいかを判定（open中は拒否、half_open中は試験呼び出し1件のみ許可）"""
+        if self.state == self.OPEN:
+            if time.monotonic() - self.opened_at < self.reset_timeout:
+                self.rejected += 1
+                return False
+            self.state = self.HALF_OPEN
+            self._probe_in_flight = False
+            logger.info(f"サーキット half_open: {self.name}")
+
+        if self.state == self.HALF_OPEN:
+            if self._probe_in_flight:
+                self.rejected += 1
+                return False
+            self._probe_in_flight = True
+
+        return True
+
+    def record_success(self) -> None:
+        self.successes += 1
+        self.consecutive_failures = 0
+        self._probe_in_flight = False
+        if self.state != self.CLOSED:
+            logger.info(f"サーキット closed: {self.name}")
+        self.state = self.CLOSED
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        self.consecutive_failures += 1
+        self._probe_in_flight = False
+        if self.state == self.HALF_OPEN or self.consecutive_failures >= self.failure_threshold:
+            if self.state != self.OPEN:
+                logger.warning(f"サーキット open: {self.name}")
+            self.state = self.OPEN
+            self.opened_at = time.monotonic()
+
+    def record_cancelled(self) -> None:
+        """キャンセルされた呼び出しは成否に数えず、試験枠だけ解放する"""
+        self._probe_in_flight = False
+
+    def stats(self) -> dict:
+        return {
+            "state": self.state,
+            "consecutive_failures": self.consecutive_failures,
+            "successes": self.successes,
+            "failures": self.failures,
+            "rejected": self.rejected,
+        }
+
+
+class UpstreamReplica:
+    """上流レプリカ1台分の状態（処理中件数・EWMAレイテンシ・排除状態）"""
+
+    def __init__(self, url: str, api_name: str):
+        self.url = url
+        self.client = GradioQueueClient(url, api_name)
+        self.outstanding = 0
+        self.ewma_latency: Optional[float] = None
+        self.consecutive_failures = 0
+        self.ejected_until = 0.0
+        self.ejections = 0
+        self._eject_seconds = REPLICA_EJECT_SECONDS
+
+    @property
+    def ejected(self) -> bool:
+        return time.monotonic() < self.ejected_until
+
+    def record_success(self, latency: float) -> None:
+        if self.ewma_latency is None:
+            self.ewma_latency = latency
+        else:
+            self.ewma_latency = REPLICA_EWMA_ALPHA * latency + (1 - REPLICA_EWMA_ALPHA) * self.ewma_latency
+        self.consecutive_failures = 0
+        self._eject_seconds = REPLICA_EJECT_SECONDS
+
+    def record_failure(self) -> None:
+        self.consecutive_failures += 1
+        if self.consecutive_failures >= REPLICA_EJECT_FAILURES and not self.ejected:
+            # 再投入直後に再び失敗した場合は排除時間を倍々に延ばす
+            self.ejected_until = time.monotonic() + self._eject_seconds
+            self.ejections += 1
+            logger.warning(f"レプリカを一時排除しました: {self.url} ({self._eject_seconds:.0f}秒)")
+            self._eject_seconds = min(self._eject_seconds * 2, REPLICA_EJECT_MAX_SECONDS)
+
+    def stats(self) -> dict:
+        return {
+            "url": self.url,
+            "outstanding": self.outstanding,
+            "ewma_latency": round(self.ewma_latency, 3) if self.ewma_latency is not None else None,
+            "ejected": self.ejected,
+            "ejections": self.ejections,
+            "consecutive_failures": self.consecutive_failures,
+            "queue": self.client.stats(),
+        }
+
+
+class ReplicaPool:
+    """
+    複数レプリカへの負荷分散
+    least_outstanding: 処理中件数が最少のレプリカ（同数ならEWMAレイテンシが小さい方）
+    ewma: EWMAレイテンシ×(処理中件数+1) が最小のレプリカ
+    連続失敗したレプリカは一定時間排除し、期限後に自動で再投入する
+    """
+
+    def __init__(self, urls: list, api_name: str, balancing: str = "least_outstanding"):
+        self.replicas = [UpstreamReplica(url, api_name) for url in urls]
+        self.balancing = balancing
+
+    def _score(self, replica: UpstreamReplica) -> tuple:
+        # 未計測のレプリカは優先的に試す
+        latency = replica.ewma_latency if replica.ewma_latency is not None else 0.0
+        if self.balancing == "ewma":
+            return (latency * (replica.outstanding + 1), replica.outstanding)
+        return (replica.outstanding, latency)
+
+    def choose(self, exclude: tuple = ()) -> UpstreamReplica:
+        candidates = [r for r in self.replicas if r not in exclude] or self.replicas
+        healthy = [r for r in candidates if not r.ejected]
+        if not healthy:
+            # 全台排除中は最も早く復帰するレプリカに送る
+            return min(candidates, key=lambda r: r.ejected_until)
+        return min(healthy, key=self._score)
+
+    @asynccontextmanager
+    async def track(self, replica: UpstreamReplica):
+        """呼び出し中の処理中件数・レイテンシ・成否を記録"""
+        replica.outstanding += 1
+        started_at = time.monotonic()
+        try:
+            yield replica
+        except asyncio.CancelledError:
+            raise
+        except UpstreamError as e:
+            # モデル処理エラーはレプリカ自体は応答しているため、ブレーカーと同様に故障として数えない
+            if e.kind == UpstreamError.SOFT_ERROR:
+                replica.record_success(time.monotonic() - started_at)
+            else:
+                replica.record_failure()
+            raise
+        except Exception:
+            replica.record_failure()
+            raise
+        else:
+            replica.record_success(time.monotonic() - started_at)
+        finally:
+            replica.outstanding -= 1
+
+    def stats(self) -> dict:
+        return {
+            "balancing": self.balancing,
+            "replicas": [replica.stats() for replica in self.replicas],
+        }
+
+
+class SpaceKeepWarm:
+    """
+    Spaceのスリープ・コールドスタート対策
+    定期的にSpaceの稼働状態を確認し、起動時とアイドル時間経過後に
+    合成画像でウォームアップOCRを実行してモデルを読み込ませておく
+    """
+
+    # HuggingFace Hub の runtime.stage のうち、リクエストで起こす必要がある状態
+    COLD_STAGES = {"SLEEPING", "PAUSED", "STOPPED"}
+    STARTING_STAGES = {"BUILDING", "APP_STARTING", "RUNNING_BUILDING", "RUNNING_APP_STARTING"}
+
+    def __init__(self):
+        self.state = "unknown"
+        self.stage: Optional[str] = None
+        self.last_success_at: Optional[float] = None
+        self.last_warmup_at: Optional[float] = None
+        self.warmups = 0
+        self.warmup_failures = 0
+        self._task: Optional[asyncio.Task] = None
+
+    def record_success(self) -> None:
+        """実リクエスト・ウォームアップの成功を記録"""
+        self.last_success_at = time.time()
+        self.state = "warm"
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self) -> None:
+        # 起動直後に1回ウォームアップし、以後は定期的に状態確認
+        await self.warm_up()
+        while True:
+            await asyncio.sleep(KEEP_WARM_INTERVAL)
+            try:
+                await self.check()
+                idle = time.time() - (self.last_success_at or 0.0)
+                if self.state != "warm" or idle >= KEEP_WARM_IDLE_SECONDS:
+                    await self.warm_up()
+            except Exception as e:
+                logger.warning(f"キープウォーム処理エラー: {e}")
+
+    async def _fetch_stage(self, session: aiohttp.ClientSession) -> Optional[str]:
+        """HuggingFace Hub APIでSpaceの稼働ステージを取得（Space名設定時のみ）"""
+        if not HUGGINGFACE_SPACE_NAME:
+            return None
+        async with session.get(
+            f"https://huggingface.co/api/spaces/{HUGGINGFACE_SPACE_NAME}/runtime",
+            timeout=aiohttp.ClientTimeout(total=10)
+        ) as response:
+            if response.status != 200:
+                return None
+            return (await response.json()).get("stage")
+
+    async def check(self) -> None:
+        """Spaceへ軽量なpingを送り、稼働状態を更新する（URLへのアクセス自体がSpaceを起こす）"""
+        session = get_http_session()
+        try:
+            self.stage = await self._fetch_stage(session)
+        except Exception as e:
+            logger.warning(f"Space稼働状態の取得に失敗しました: {e}")
+
+        if self.stage in self.COLD_STAGES:
+            self.state = "sleeping"
+        elif self.stage in self.STARTING_STAGES:
+            self.state = "starting"
+
+        for url in HUGGINGFACE_SPACE_URLS:
+            try:
+                async with session.get(
+                    f"{url}/config",
+                    timeout=aiohttp.ClientTimeout(total=10)
+                ) as response:
+                    if response.status != 200 and self.state == "warm":
+                        self.state = "cold"
+            except Exception:
+                if self.state == "warm":
+                    self.state = "cold"
+
+    async def warm_up(self) -> None:
+        """合成画像でOCRを1回実行し、モデル読み込みまで済ませる"""
+        if not configured_upstream_methods():
+            return
+        self.last_warmup_at = time.time()
+        self.warmups += 1
+        logger.info("Spaceのウォームアップを開始します...")
+        try:
+            # コールドスタートは数分かかるため通常より長い予算を与え、
+            # レイテンシ統計（タイムアウト・ヘッジの基準）には含めない
+            budget = UpstreamBudget(
+                connect=UPSTREAM_CONNECT_TIMEOUT,
+                first_byte=KEEP_WARM_TIMEOUT,
+                total=KEEP_WARM_TIMEOUT
+            )
+            await _call_primary(warmup_image(), budget)
+            self.record_success()
+            logger.info(f"Spaceのウォームアップ完了: {time.time() - self.last_warmup_at:.1f}秒")
+        except Exception as e:
+            self.warmup_failures += 1
+            self.state = "cold"
+            logger.warning(f"Spaceのウォームアップに失敗しました: {e}")
+
+    def stats(self) -> dict:
+        now = time.time()
+        return {
+            "enabled": KEEP_WARM_ENABLED,
+            # 複数ワーカーではリースを持つ1ワーカーだけが実行する
+            "running": self._task is not None,
+            "state": self.state,
+            "stage": self.stage,
+            "seconds_since_last_success": (
+                round(now - self.last_success_at, 1) if self.last_success_at else None
+            ),
+            "seconds_since_last_warmup": (
+                round(now - self.last_warmup_at, 1) if self.last_warmup_at else None
+            ),
+            "warmups": self.warmups,
+            "warmup_failures": self.warmup_failures,
+        }
+
+
+def warmup_image() -> bytes:
+    """ウォームアップ用の小さな合成画像（文字入り）を生成"""
+    from PIL import ImageDraw
+
+    image = Image.new('RGB', (320, 80), 'white')
+    ImageDraw.Draw(image).text((10, 30), "OCR warm-up 12345", fill='black')
+    output = io.BytesIO()
+    image.save(output, format='JPEG', quality=85)
+    return output.getvalue()
+
+
+class ResultCache:
+    """
+    OCR結果のインメモリキャッシュ
+    LRU順で保持し、TTL切れと合計サイズ（バイト数の概算）の上限で追い出す
+    Railway $5プランのメモリ制限(512MB)内に収まるよう上限はバイト数で指定する
+    """
+
+    # 1エントリあたりの辞書・キー文字列などのおおよそのオーバーヘッド
+    ENTRY_OVERHEAD = 512
+
+    def __init__(self, max_bytes: int, ttl: float):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._entries: OrderedDict = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    @classmethod
+    def entry_size(cls, key: str, entry: dict) -> int:
+        return cls.ENTRY_OVERHEAD + len(key) + len(str(entry.get("text", "")).encode("utf-8"))
+
+    def get(self, key: str) -> Optional[dict]:
+        item = self._entries.get(key)
+        if item is None:
+            self.misses += 1
+            return None
+        entry, expires_at, size = item
+        if time.time() >= expires_at:
+            self._remove(key)
+            self.expirations += 1
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry
+
+    def put(self, key: str, entry: dict) -> None:
+        size = self.entry_size(key, entry)
+        if size > self.max_bytes:
+            return
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = (entry, time.time() + self.ttl, size)
+        self.bytes += size
+        while self.bytes > self.max_bytes and self._entries:
+            oldest = next(iter(self._entries))
+            self._remove(oldest)
+            self.evictions += 1
+
+    def _remove(self, key: str) -> None:
+        _, _, size = self._entries.pop(key)
+        self.bytes -= size
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "enabled": RESULT_CACHE_ENABLED,
+            "entries": len(self._entries),
+            "bytes": self.bytes,
+            "max_bytes": self.max_bytes,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else None,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
+
+
+class DiskResultCache:
+    """
+    SQLite（WALモード）によるOCR結果の永続キャッシュ
+    再起動・再デプロイ後もヒット率を保ち、複数のuvicornワーカーから同時に読み書きできる
+    SQLiteの呼び出しはすべてスレッドで実行し、イベントループをブロックしない
+    """
+
+    # 最終アクセス時刻の更新間隔（ヒットのたびに書き込まないため）
+    TOUCH_INTERVAL = 60.0
+    # 何回の書き込みごとに合計サイズを確認するか
+    EVICTION_CHECK_EVERY = 50
+
+    def __init__(self, path: str, max_bytes: int, ttl: float):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._local = threading.local()
+        self._writes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.errors = 0
+
+    def _connect(self) -> sqlite3.Connection:
+        """スレッドごとに1本の接続を使い回す"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=5.0, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA busy_timeout=5000")
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS results (
+                    key TEXT PRIMARY KEY,
+                    content_hash TEXT NOT NULL,
+                    options_hash TEXT NOT NULL,
+                    text TEXT NOT NULL,
+                    confidence REAL,
+                    model_used TEXT,
+                    size INTEGER NOT NULL,
+                    created_at REAL NOT NULL,
+                    accessed_at REAL NOT NULL
+                )
+                """
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS results_accessed_at ON results (accessed_at)")
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS raw_digests (
+                    raw_key TEXT PRIMARY KEY,
+                    cache_key TEXT NOT NULL,
+                    accessed_at REAL NOT NULL
+                )
+                """
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS raw_digests_accessed_at ON raw_digests (accessed_at)")
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(results)")}
+            if "phash" not in columns:
+                conn.execute("ALTER TABLE results ADD COLUMN phash TEXT")
+            self._local.conn = conn
+        return conn
+
+    def _get(self, key: str) -> Optional[dict]:
+        conn = self._connect()
+        row = conn.execute(
+            "SELECT text, confidence, model_used, created_at, accessed_at FROM results WHERE key = ?",
+            (key,)
+        ).fetchone()
+        if row is None:
+            return None
+        text, confidence, model_used, created_at, accessed_at = row
+        now = time.time()
+        if now - created_at >= self.ttl:
+            conn.execute("DELETE FROM results WHERE key = ?", (key,))
+            return None
+        if now - accessed_at >= self.TOUCH_INTERVAL:
+            conn.execute("UPDATE results SET accessed_at = ? WHERE key = ?", (now, key))
+        return {"text": text, "confidence": confidence, "model_used": model_used}
+
+    def _put(self, key: str, entry: dict, fingerprint: Optional[int] = None) -> None:
+        conn = self._connect()
+        content_hash, _, options_hash = key.partition(":")
+        text = str(entry.get("text", ""))
+        size = ResultCache.entry_size(key, entry)
+        now = time.time()
+        conn.execute(
+            """
+            INSERT OR REPLACE INTO results
+                (key, content_hash, options_hash, text, confidence, model_used, size,
+                 created_at, accessed_at, phash)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """,
+            (key, content_hash, options_hash, text, entry.get("confidence"),
+             entry.get("model_used"), size, now, now,
+             format(fingerprint, "x") if fingerprint is not None else None)
+        )
+        self._writes += 1
+        if self._writes % self.EVICTION_CHECK_EVERY == 1:
+            self._evict(conn)
+
+    def _evict(self, conn: sqlite3.Connection) -> None:
+        """TTL切れを削除し、合計サイズが上限を超えていれば最終アクセスの古い順に削除"""
+        conn.execute("DELETE FROM results WHERE created_at < ?", (time.time() - self.ttl,))
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM results").fetchone()[0]
+        while total > self.max_bytes:
+            rows = conn.execute(
+                "SELECT key, size FROM results ORDER BY accessed_at LIMIT 500"
+            ).fetchall()
+            if not rows:
+                break
+            conn.executemany("DELETE FROM results WHERE key = ?", [(key,) for key, _ in rows])
+            total -= sum(size for _, size in rows)
+            self.evictions += len(rows)
+
+    async def get(self, key: str) -> Optional[dict]:
+        try:
+            entry = await asyncio.to_thread(self._get, key)
+        except sqlite3.Error as e:
+            self.errors += 1
+            logger.warning(f"ディスクキャッシュ読み込みエラー: {e}")
+            return None
+        if entry is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return entry
+
+    async def put(self, key: str, entry: dict, fingerprint: Optional[int] = None) -> None:
+        try:
+            await asyncio.to_thread(self._put, key, entry, fingerprint)
+        except sqlite3.Error as e:
+            self.errors += 1
+            logger.warning(f"ディスクキャッシュ書き込みエラー: {e}")
+
+    def _get_raw_digest(self, raw_key: str) -> Optional[str]:
+        conn = self._connect()
+        row = conn.execute(
+            "SELECT cache_key, accessed_at FROM raw_digests WHERE raw_key = ?", (raw_key,)
+        ).fetchone()
+        if row is None:
+            return None
+        # results と同じく参照時刻を更新し、上限超過時は最も長く使われていない対応から捨てる
+        now = time.time()
+        if now - row[1] >= self.TOUCH_INTERVAL:
+            conn.execute("UPDATE raw_digests SET accessed_at = ? WHERE raw_key = ?", (now, raw_key))
+        return row[0]
+
+    def _touch_raw_digest(self, raw_key: str) -> None:
+        self._connect().execute(
+            "UPDATE raw_digests SET accessed_at = ? WHERE raw_key = ?", (time.time(), raw_key)
+        )
+
+    def _put_raw_digest(self, raw_key: str, cache_key: str, max_entries: int) -> None:
+        conn = self._connect()
+        conn.execute(
+            "INSERT OR REPLACE INTO raw_digests (raw_key, cache_key, accessed_at) VALUES (?, ?, ?)",
+            (raw_key, cache_key, time.time())
+        )
+        self._writes += 1
+        if self._writes % self.EVICTION_CHECK_EVERY == 1:
+            conn.execute(
+                """
+                DELETE FROM raw_digests WHERE raw_key IN (
+                    SELECT raw_key FROM raw_digests ORDER BY accessed_at DESC LIMIT -1 OFFSET ?
+                )
+                """,
+                (max_entries,)
+            )
+
+    def _find_stale(self, file_sha256: str, options_hash: str) -> Optional[tuple]:
+        # raw_key は "{file_sha256}:{options_hash}" なので主キーの範囲検索で全名前空間を引ける
+        row = self._connect().execute(
+            """
+            SELECT r.key, r.text, r.confidence, r.model_used, r.created_at
+            FROM raw_digests d JOIN results r ON r.key = d.cache_key
+            WHERE d.raw_key >= ? AND d.raw_key < ? AND d.raw_key != ?
+            ORDER BY r.created_at DESC LIMIT 1
+            """,
+            (f"{file_sha256}:", f"{file_sha256};", f"{file_sha256}:{options_hash}")
+        ).fetchone()
+        if row is None or time.time() - row[4] > self.ttl:
+            return None
+        return row[0], {"text": row[1], "confidence": row[2], "model_used": row[3]}
+
+    async def find_stale(self, file_sha256: str, options_hash: str) -> Optional[tuple]:
+        """同じ元ファイルについて、別の名前空間（旧モデル・旧前処理設定）で保存された結果を探す"""
+        try:
+            return await asyncio.to_thread(self._find_stale, file_sha256, options_hash)
+        except sqlite3.Error as e:
+            self.errors += 1
+            logger.warning(f"ディスクキャッシュ読み込みエラー: {e}")
+            return None
+
+    async def get_raw_digest(self, raw_key: str) -> Optional[str]:
+        """元ファイルのハッシュから結果キャッシュキーを引く"""
+        try:
+            return await asyncio.to_thread(self._get_raw_digest, raw_key)
+        except sqlite3.Error as e:
+            self.errors += 1
+            logger.warning(f"ディスクキャッシュ読み込みエラー: {e}")
+            return None
+
+    async def touch_raw_digest(self, raw_key: str) -> None:
+        """メモリ上でヒットした対応の参照時刻をディスク側にも反映する"""
+        try:
+            await asyncio.to_thread(self._touch_raw_digest, raw_key)
+        except sqlite3.Error as e:
+            self.errors += 1
+            logger.warning(f"ディスクキャッシュ書き込みエラー: {e}")
+
+    async def put_raw_digest(self, raw_key: str, cache_key: str, max_entries: int) -> None:
+        try:
+            await asyncio.to_thread(self._put_raw_digest, raw_key, cache_key, max_entries)
+        except sqlite3.Error as e:
+            self.errors += 1
+            logger.warning(f"ディスクキャッシュ書き込みエラー: {e}")
+
+    def _load_fingerprints(self, limit: int) -> list:
+        rows = self._connect().execute(
+            "SELECT key, phash FROM results WHERE phash IS NOT NULL ORDER BY accessed_at DESC LIMIT ?",
+            (limit,)
+        ).fetchall()
+        fingerprints = []
+        for key, phash in rows:
+            try:
+                fingerprints.append((key, int(phash, 16)))
+            except ValueError:
+                # 以前のインポートで入った不正な値は索引に載せない
+                continue
+        return fingerprints
+
+    async def load_fingerprints(self, limit: int) -> list:
+        """最近使われた結果の知覚ハッシュを読み出す（起動時の索引再構築用）"""
+        try:
+            return await asyncio.to_thread(self._load_fingerprints, limit)
+        except sqlite3.Error as e:
+            self.errors += 1
+            logger.warning(f"ディスクキャッシュ読み込みエラー: {e}")
+            return []
+
+    def export_chunk(self, after_key: str, limit: int) -> list:
+        """
+        キー順に after_key より後の結果を最大 limit 件読み出す（キーセットページングでメモリを一定に保つ）
+        同期メソッド（CLIから直接、APIからは to_thread 経由で呼ぶ）
+        """
+        conn = self._connect()
+        rows = conn.execute(
+            """
+            SELECT key, content_hash, options_hash, text, confidence, model_used, created_at, phash
+            FROM results WHERE key > ? AND created_at >= ? ORDER BY key LIMIT ?
+            """,
+            (after_key, time.time() - self.ttl, limit)
+        ).fetchall()
+        file_hashes: dict = {}
+        if rows:
+            placeholders = ",".join("?" * len(rows))
+            for raw_key, cache_key in conn.execute(
+                f"SELECT raw_key, cache_key FROM raw_digests WHERE cache_key IN ({placeholders})",
+                [row[0] for row in rows]
+            ):
+                file_hashes.setdefault(cache_key, []).append(raw_key.partition(":")[0])
+        return [
+            {
+                "key": key,
+                "content_hash": content_hash,
+                "options_hash": options_hash,
+                "text": text,
+                "confidence": confidence,
+                "model_used": model_used,
+                "created_at": created_at,
+                "phash": phash,
+                "file_sha256": file_hashes.get(key, []),
+            }
+            for key, content_hash, options_hash, text, confidence, model_used, created_at, phash in rows
+        ]
+
+    def import_records(self, records: list) -> int:
+        """
+        検証済みのレコードを1トランザクションでまとめて書き込み、書き込んだ件数を返す
+        作成時刻を引き継ぐのでTTLと容量上限による削除は元の古さに従う
+        """
+        conn = self._connect()
+        now = time.time()
+        rows = []
+        raw_rows = []
+        for record in records:
+            created_at = record.get("created_at") or now
+            if now - created_at >= self.ttl:
+                continue
+            key = f"{record['content_hash']}:{record['options_hash']}"
+            entry = {
+                "text": record["text"],
+                "confidence": record.get("confidence"),
+                "model_used": record.get("model_used"),
+            }
+            rows.append((key, record["content_hash"], record["options_hash"], entry["text"],
+                         entry["confidence"], entry["model_used"],
+                         ResultCache.entry_size(key, entry), created_at, created_at,
+                         record.get("phash")))
+            raw_rows.extend(
+                (f"{file_sha256}:{record['options_hash']}", key, created_at)
+                for file_sha256 in record.get("file_sha256", [])
+            )
+        conn.execute("BEGIN")
+        try:
+            conn.executemany(
+                """
+                INSERT OR REPLACE INTO results
+                    (key, content_hash, options_hash, text, confidence, model_used, size,
+                     created_at, accessed_at, phash)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                """,
+                rows
+            )
+            conn.executemany(
+                "INSERT OR REPLACE INTO raw_digests (raw_key, cache_key, accessed_at) VALUES (?, ?, ?)",
+                raw_rows
+            )
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        self._evict(conn)
+        return len(rows)
+
+    def _summary(self) -> tuple:
+        return self._connect().execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM results"
+        ).fetchone()
+
+    async def stats(self) -> dict:
+        try:
+            entries, total = await asyncio.to_thread(self._summary)
+        except sqlite3.Error:
+            entries, total = None, None
+        return {
+            "path": self.path,
+            "entries": entries,
+            "bytes": total,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "errors": self.errors,
+        }
+
+
+class RawDigestIndex:
+    """
+    元ファイル（最適化前）のSHA-256＋OCRオプション → 結果キャッシュキーの対応表
+    クライアントがハッシュだけで結果を問い合わせられるようにする
+    ディスクキャッシュがあれば全件はSQLite側に置き、ここは合計サイズで制限したLRUのホットキャッシュ
+    """
+
+    # 1エントリあたりの辞書・リスト・時刻などのおおよそのオーバーヘッド（2本のキー文字列を除く）
+    ENTRY_OVERHEAD = 280
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max(0, max_bytes)
+        self._entries: OrderedDict = OrderedDict()
+        self._bytes = 0
+
+    @classmethod
+    def _entry_size(cls, raw_key: str, cache_key: str) -> int:
+        return len(raw_key) + len(cache_key) + cls.ENTRY_OVERHEAD
+
+    @staticmethod
+    def key(file_sha256: str, options_hash: str) -> str:
+        return f"{file_sha256.lower()}:{options_hash}"
+
+    def get(self, raw_key: str) -> Optional[str]:
+        entry = self._entries.get(raw_key)
+        if entry is None:
+            return None
+        self._entries.move_to_end(raw_key)
+        return entry[0]
+
+    def touch_due(self, raw_key: str, interval: float) -> bool:
+        """前回ディスク側の参照時刻を更新してから interval 秒以上経っていれば True（時刻を更新する）"""
+        entry = self._entries.get(raw_key)
+        now = time.monotonic()
+        if entry is None or now - entry[1] < interval:
+            return False
+        entry[1] = now
+        return True
+
+    def put(self, raw_key: str, cache_key: str) -> None:
+        previous = self._entries.pop(raw_key, None)
+        if previous is not None:
+            self._bytes -= self._entry_size(raw_key, previous[0])
+        # [キャッシュキー, ディスク側の参照時刻を最後に更新した時刻]
+        self._entries[raw_key] = [cache_key, time.monotonic()]
+        self._bytes += self._entry_size(raw_key, cache_key)
+        while self._entries and self._bytes > self.max_bytes:
+            evicted_key, evicted = self._entries.popitem(last=False)
+            self._bytes -= self._entry_size(evicted_key, evicted[0])
+
+    def stats(self) -> dict:
+        return {"entries": len(self._entries), "bytes": self._bytes, "max_bytes": self.max_bytes}
+
+
+class PerceptualIndex:
+    """
+    知覚ハッシュのBK木による近傍検索インデックス
+    ハミング距離が閾値以内の既知画像（のキャッシュキー）を探す
+    上限件数を超えたら古い半分を捨てて木を再構築する
+    """
+
+    # 1エントリあたりのおおよそのメモリ（256ビットのハッシュ・キー文字列・木のノード。実測で約490バイト）
+    ENTRY_BYTES = 512
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max(1, max_entries)
+        self._entries: OrderedDict = OrderedDict()
+        # ノードは [ハッシュ, キャッシュキー, {距離: 子ノード}]
+        self._root: Optional[list] = None
+        self.hits = 0
+
+    def add(self, fingerprint: int, key: str) -> None:
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            return
+        self._entries[key] = fingerprint
+        self._insert(fingerprint, key)
+        if len(self._entries) > self.max_entries:
+            for _ in range(len(self._entries) // 2):
+                self._entries.popitem(last=False)
+            self._root = None
+            for entry_key, entry_fingerprint in self._entries.items():
+                self._insert(entry_fingerprint, entry_key)
+
+    def _insert(self, fingerprint: int, key: str) -> None:
+        if self._root is None:
+            self._root = [fingerprint, key, {}]
+            return
+        node = self._root
+        while True:
+            distance = (fingerprint ^ node[0]).bit_count()
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = [fingerprint, key, {}]
+                return
+            node = child
+
+    def search(self, fingerprint: int, max_distance: int) -> list:
+        """距離 max_distance 以内の (距離, キー) を近い順に返す"""
+        results = []
+        stack = [self._root] if self._root is not None else []
+        while stack:
+            node = stack.pop()
+            distance = (fingerprint ^ node[0]).bit_count()
+            if distance <= max_distance and node[1] in self._entries:
+                results.append((distance, node[1]))
+            for child_distance, child in node[2].items():
+                if distance - max_distance <= child_distance <= distance + max_distance:
+                    stack.append(child)
+        return sorted(results)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def stats(self) -> dict:
+        return {
+            "enabled": PHASH_ENABLED,
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "max_distance": PHASH_MAX_DISTANCE,
+            "hash_bits": PHASH_HASH_SIZE * PHASH_HASH_SIZE,
+            "hits": self.hits,
+        }
+
+
+class SingleFlight:
+    """
+    同じキーで同時に発生した処理を1回の実行にまとめ、結果を全員に配る
+    先頭リクエストが切断されても他の待機者がいる限り処理は継続し、
+    待機者が全員いなくなった時点で共有の処理をキャンセルする
+    """
+
+    class _Flight:
+        def __init__(self, task: asyncio.Task):
+            self.task = task
+            self.waiters = 0
+
+    def __init__(self):
+        self._flights: dict = {}
+        self.coalesced = 0
+
+    def _forget(self, key: str, flight: "_Flight") -> None:
+        if self._flights.get(key) is flight:
+            del self._flights[key]
+
+    async def do(self, key: str, factory):
+        flight = self._flights.get(key)
+        if flight is None:
+            flight = self._Flight(asyncio.create_task(factory()))
+            self._flights[key] = flight
+            flight.task.add_done_callback(lambda _: self._forget(key, flight))
+        else:
+            self.coalesced += 1
+            METRICS["coalesced_requests"] += 1
+
+        flight.waiters += 1
+        try:
+            # 待機者のキャンセルが共有の処理に波及しないよう shield で待つ
+            return await asyncio.shield(flight.task)
+        finally:
+            flight.waiters -= 1
+            if flight.waiters == 0 and not flight.task.done():
+                self._forget(key, flight)
+                flight.task.cancel()
+
+    def stats(self) -> dict:
+        return {
+            "in_flight": len(self._flights),
+            "coalesced": self.coalesced,
+        }
+
+
+class StaleRewarmer:
+    """
+    旧名前空間の結果を返したキーを、新しいモデル・前処理設定でバックグラウンド再計算する
+    一斉にキャッシュを捨てて上流へ殺到させないよう、参照回数の多いキーから一定レートで処理する
+    （ゲートウェイは元画像を保持しないため、stale な結果を返した際のアップロード画像を使う）
+    待ち行列には元画像ではなく最適化済み画像を置き、合計バイト数で上限を設ける
+    """
+
+    # 最適化待ち（元画像を保持している）の同時件数
+    MAX_PREPARING = 2
+
+    def __init__(self, rate_per_minute: float, max_bytes: int):
+        self.rate_per_minute = rate_per_minute
+        self.interval = 60.0 / rate_per_minute if rate_per_minute > 0 else None
+        self.max_bytes = max_bytes
+        # raw_key → [参照回数, PreprocessedImage]
+        self._pending: dict = {}
+        self._pending_bytes = 0
+        # 最適化中の raw_key → 参照回数
+        self._preparing: dict = {}
+        self._prepare_tasks: set = set()
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self.enqueued = 0
+        self.dropped = 0
+        self.rewarmed = 0
+        self.failures = 0
+
+    def request(self, raw_key: str, image_data: bytes) -> None:
+        """stale な結果を返したキーを再計算待ちに登録する（登録済みなら参照回数を加算）"""
+        if self.interval is None or self._task is None:
+            return
+        pending = self._pending.get(raw_key)
+        if pending is not None:
+            pending[0] += 1
+            return
+        if raw_key in self._preparing:
+            self._preparing[raw_key] += 1
+            return
+        if len(self._preparing) >= self.MAX_PREPARING:
+            self.dropped += 1
+            return
+        self._preparing[raw_key] = 1
+        task = asyncio.create_task(self._prepare(raw_key, image_data))
+        self._prepare_tasks.add(task)
+        task.add_done_callback(self._prepare_tasks.discard)
+
+    async def _prepare(self, raw_key: str, image_data: bytes) -> None:
+        try:
+            preprocessed = await preprocess_pool.run(image_data, with_fingerprint=PHASH_ENABLED)
+        except Exception as e:
+            self._preparing.pop(raw_key, None)
+            self.dropped += 1
+            logger.warning(f"キャッシュ再計算の準備に失敗しました: {e}")
+            return
+        self._enqueue(raw_key, self._preparing.pop(raw_key, 1), preprocessed)
+
+    def _enqueue(self, raw_key: str, hits: int, preprocessed: "PreprocessedImage") -> None:
+        size = len(preprocessed.data)
+        if size > self.max_bytes:
+            self.dropped += 1
+            return
+        while self._pending_bytes + size > self.max_bytes:
+            # 最も参照の少ないキーより冷たければ登録しない
+            coldest = min(self._pending, key=lambda k: self._pending[k][0])
+            if self._pending[coldest][0] > hits:
+                self.dropped += 1
+                return
+            self._pending_bytes -= len(self._pending.pop(coldest)[1].data)
+            self.dropped += 1
+        self._pending[raw_key] = [hits, preprocessed]
+        self._pending_bytes += size
+        self.enqueued += 1
+        self._wakeup.set()
+
+    def start(self) -> None:
+        if self._task is None and self.interval is not None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        tasks = list(self._prepare_tasks)
+        if self._task is not None:
+            tasks.append(self._task)
+            self._task = None
+        for task in tasks:
+            task.cancel()
+        for task in tasks:
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+
+    async def _run(self) -> None:
+        while True:
+            if not self._pending:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+            raw_key = max(self._pending, key=lambda k: self._pending[k][0])
+            _, preprocessed = self._pending.pop(raw_key)
+            self._pending_bytes -= len(preprocessed.data)
+            try:
+                await self.rewarm(raw_key, preprocessed)
+                self.rewarmed += 1
+                METRICS["stale_rewarmed"] += 1
+            except Exception as e:
+                self.failures += 1
+                logger.warning(f"キャッシュ再計算エラー: {e}")
+            await asyncio.sleep(self.interval)
+
+    async def rewarm(self, raw_key: str, preprocessed: "PreprocessedImage") -> None:
+        if await raw_digest_lookup(raw_key) is not None:
+            # 通常のリクエストで既に再計算済み
+            return
+        cache_key = result_cache_key(preprocessed.data, ocr_options())
+        await single_flight.do(
+            cache_key,
+            lambda: load_ocr_result(cache_key, preprocessed.data, preprocessed.fingerprint)
+        )
+        await raw_digest_store(raw_key, cache_key)
+
+    def stats(self) -> dict:
+        return {
+            "pending": len(self._pending),
+            "pending_bytes": self._pending_bytes,
+            "max_bytes": self.max_bytes,
+            "preparing": len(self._preparing),
+            "rate_per_minute": self.rate_per_minute,
+            "enqueued": self.enqueued,
+            "dropped": self.dropped,
+            "rewarmed": self.rewarmed,
+            "failures": self.failures,
+        }
+
+
+class PeerUnavailable(Exception):
+    """担当ノードに問い合わせできなかった（自ノードで処理してよい）"""
+
+
+class HashRing:
+    """仮想ノード付きのコンシステントハッシュ（ノード増減時に移動するキーを最小にする）"""
+
+    def __init__(self, nodes: list, vnodes: int):
+        points = sorted(
+            (self._hash(f"{node}#{i}"), node) for node in nodes for i in range(vnodes)
+        )
+        self._hashes = [h for h, _ in points]
+        self._nodes = [node for _, node in points]
+
+    @staticmethod
+    def _hash(value: str) -> int:
+        return int.from_bytes(hashlib.md5(value.encode()).digest()[:8], "big")
+
+    def node_for(self, key: str) -> str:
+        index = bisect.bisect(self._hashes, self._hash(key)) % len(self._hashes)
+        return self._nodes[index]
+
+
+class PeerGroup:
+    """
+    groupcache方式の分散結果キャッシュ
+    キーごとに担当ノードを決め、担当外のキーは担当ノードにHTTPで問い合わせる
+    担当ノードは自分のキャッシュと SingleFlight で同時の読み込みを1回にまとめるため、
+    同じ文書がノードの数だけOCRされることがない
+    """
+
+    # 応答しなかったノードを担当から外しておく時間（その間のキーは自ノードで処理）
+    DOWN_SECONDS = 30.0
+
+    def __init__(self, self_url: str, peers: list, vnodes: int):
+        self.self_url = self_url
+        self.peers = sorted(set(peers) | {self_url})
+        self.ring = HashRing(self.peers, vnodes)
+        self._down_until: dict = {}
+        self.remote_loads = 0
+        self.remote_failures = 0
+        self.served = 0
+
+    def owner(self, key: str) -> Optional[str]:
+        """担当ノードのURL（自ノードが担当、または担当ノードが停止中なら None）"""
+        node = self.ring.node_for(key)
+        if node == self.self_url or time.monotonic() < self._down_until.get(node, 0.0):
+            return None
+        return node
+
+    async def load(self, node: str, key: str, image_data: bytes, fingerprint: Optional[int]) -> dict:
+        """担当ノードに結果を問い合わせる（担当ノードは未処理ならOCRを実行する）"""
+        headers = {"Content-Type": "application/octet-stream"}
+        if CACHE_PEER_TOKEN:
+            headers["X-Peer-Token"] = CACHE_PEER_TOKEN
+        if fingerprint is not None:
+            headers["X-Peer-Fingerprint"] = format(fingerprint, "x")
+        self.remote_loads += 1
+        try:
+            async with get_http_session().post(
+                f"{node}/api/v1/internal/cache/{key}",
+                data=image_data,
+                headers=headers,
+                timeout=aiohttp.ClientTimeout(total=CACHE_PEER_TIMEOUT, connect=2.0)
+            ) as response:
+                body = await response.json(content_type=None)
+                if response.status == 200:
+                    return body
+                if response.status == 502:
+                    # 担当ノードで上流が失敗した。自ノードでやり直すと上流への負荷が重複するので失敗とする
+                    raise UpstreamError(
+                        f"担当ノードでOCRに失敗しました: {body.get('detail')}",
+                        body.get("kind", UpstreamError.TRANSPORT)
+                    )
+                raise PeerUnavailable(f"HTTP {response.status}: {body.get('detail')}")
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+            self.remote_failures += 1
+            self._down_until[node] = time.monotonic() + self.DOWN_SECONDS
+            raise PeerUnavailable(f"{type(e).__name__}: {e}") from e
+        except PeerUnavailable:
+            self.remote_failures += 1
+            raise
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        return {
+            "self": self.self_url,
+            "peers": self.peers,
+            "down": [node for node, until in self._down_until.items() if until > now],
+            "remote_loads": self.remote_loads,
+            "remote_failures": self.remote_failures,
+            "served": self.served,
+        }
+
+
+def ocr_options() -> dict:
+    """
+    結果に影響するOCRオプション（キャッシュキーの名前空間になる）
+    モデルのリビジョンや前処理設定を変えると、以前の結果は別名前空間の stale な結果として扱われる
+    """
+    return {
+        "api_name": HUGGINGFACE_API_NAME,
+        "ocr_type": OCR_TYPE,
+        "model": OCR_MODEL_ID,
+        "revision": OCR_MODEL_REVISION,
+        "max_size": PREPROCESS_MAX_SIZE,
+        "jpeg_quality": PREPROCESS_JPEG_QUALITY,
+        "jpeg_draft": PREPROCESS_JPEG_DRAFT,
+    }
+
+
+def options_digest(options: dict) -> str:
+    return hashlib.sha256(json.dumps(options, sort_keys=True).encode()).hexdigest()[:16]
+
+
+def result_cache_key(image_data: bytes, options: dict) -> str:
+    """画像内容のSHA-256とOCRオプションから結果キャッシュのキーを作る"""
+    content_hash = hashlib.sha256(image_data).hexdigest()
+    return f"{content_hash}:{options_digest(options)}"
+
+
+def result_etag(cache_key: str) -> str:
+    """結果キャッシュのキーから ETag を作る（キーが同じなら結果も同じ）"""
+    return f'"{cache_key.replace(":", "-")}"'
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """If-None-Match ヘッダーが ETag に一致するか（弱いETag・複数指定・* に対応）"""
+    if not if_none_match:
+        return False
+    candidates = [value.strip() for value in if_none_match.split(",")]
+    return "*" in candidates or any(
+        candidate.removeprefix("W/") == etag for candidate in candidates
+    )
+
+
+async def cache_lookup(key: str) -> Optional[dict]:
+    """メモリ → ディスクの順に結果キャッシュを引く（ディスクのヒットはメモリに昇格）"""
+    entry = result_cache.get(key)
+    if entry is None and disk_result_cache is not None:
+        entry = await disk_result_cache.get(key)
+        if entry is not None:
+            result_cache.put(key, entry)
+    return entry
+
+
+async def cache_store(key: str, entry: dict, fingerprint: Optional[int] = None) -> None:
+    """成功したOCR結果をメモリとディスクの両方に保存（知覚ハッシュがあれば索引にも登録）"""
+    result_cache.put(key, entry)
+    if disk_result_cache is not None:
+        await disk_result_cache.put(key, entry, fingerprint)
+    if PHASH_ENABLED and fingerprint is not None:
+        perceptual_index.add(fingerprint, key)
+
+
+def _is_sha256(value) -> bool:
+    return isinstance(value, str) and len(value) == 64 and all(c in "0123456789abcdef" for c in value)
+
+
+def parse_cache_record(line) -> Optional[dict]:
+    """
+    JSONLの1行をキャッシュ投入用のレコードに変換する（不正な行は None）
+    options_hash の代わりに options（ocr_options() と同じ形の辞書）も受け付ける
+    """
+    try:
+        record = json.loads(line)
+    except ValueError:
+        return None
+    if not isinstance(record, dict) or not isinstance(record.get("text"), str):
+        return None
+    content_hash = str(record.get("content_hash", "")).lower()
+    if not _is_sha256(content_hash):
+        return None
+    options_hash = record.get("options_hash")
+    if options_hash is None and isinstance(record.get("options"), dict):
+        options_hash = options_digest(record["options"])
+    if not isinstance(options_hash, str) or not options_hash or ":" in options_hash:
+        return None
+    file_hashes = record.get("file_sha256") or []
+    if isinstance(file_hashes, str):
+        file_hashes = [file_hashes]
+    # 知覚ハッシュは起動時に16進数として読み込み、信頼度は応答にそのまま載るため型を確かめる
+    phash = record.get("phash")
+    if phash is not None:
+        if not isinstance(phash, str) or not phash or any(c not in "0123456789abcdef" for c in phash.lower()):
+            return None
+        phash = phash.lower()
+    confidence = record.get("confidence")
+    if confidence is not None and (isinstance(confidence, bool) or not isinstance(confidence, (int, float))):
+        return None
+    model_used = record.get("model_used")
+    if model_used is not None and not isinstance(model_used, str):
+        return None
+    created_at = record.get("created_at")
+    return {
+        "content_hash": content_hash,
+        "options_hash": options_hash,
+        "text": record["text"],
+        "confidence": float(confidence) if confidence is not None else None,
+        "model_used": model_used,
+        "created_at": float(created_at) if isinstance(created_at, (int, float)) else None,
+        "phash": phash,
+        "file_sha256": [h.lower() for h in file_hashes if isinstance(h, str) and _is_sha256(h.lower())],
+    }
+
+
+def format_cache_record(record: dict) -> str:
+    """エクスポート用に1件をJSONLの1行にする（現在の名前空間ならオプションの中身も付ける）"""
+    record = {k: v for k, v in record.items() if k != "key"}
+    current = ocr_options()
+    if record["options_hash"] == options_digest(current):
+        record["options"] = current
+    return json.dumps(record, ensure_ascii=False) + "\n"
+
+
+def export_cache_jsonl(cache: DiskResultCache, out, chunk_size: int = CACHE_TRANSFER_CHUNK_SIZE) -> int:
+    """ディスクキャッシュ全体をJSONLで書き出し、件数を返す"""
+    exported = 0
+    after_key = ""
+    while True:
+        records = cache.export_chunk(after_key, chunk_size)
+        if not records:
+            return exported
+        out.writelines(format_cache_record(record) for record in records)
+        exported += len(records)
+        after_key = records[-1]["key"]
+
+
+def import_cache_jsonl(cache: DiskResultCache, lines, chunk_size: int = CACHE_TRANSFER_CHUNK_SIZE) -> dict:
+    """JSONLの行を chunk_size 件ずつディスクキャッシュに投入し、件数を返す"""
+    counts = {"imported": 0, "skipped": 0}
+    chunk = []
+    for line in lines:
+        if not line.strip():
+            continue
+        record = parse_cache_record(line)
+        if record is None:
+            counts["skipped"] += 1
+            continue
+        chunk.append(record)
+        if len(chunk) >= chunk_size:
+            imported = cache.import_records(chunk)
+            counts["imported"] += imported
+            counts["skipped"] += len(chunk) - imported
+            chunk = []
+    if chunk:
+        imported = cache.import_records(chunk)
+        counts["imported"] += imported
+        counts["skipped"] += len(chunk) - imported
+    return counts
+
+
+async def raw_digest_lookup(raw_key: str) -> Optional[str]:
+    """元ファイルのハッシュ → 結果キャッシュキー（メモリ → ディスクの順、ディスクのヒットはメモリに昇格）"""
+    cache_key = raw_digest_index.get(raw_key)
+    if disk_result_cache is not None:
+        if cache_key is None:
+            cache_key = await disk_result_cache.get_raw_digest(raw_key)
+            if cache_key is not None:
+                raw_digest_index.put(raw_key, cache_key)
+        elif raw_digest_index.touch_due(raw_key, DiskResultCache.TOUCH_INTERVAL):
+            # メモリでヒットし続ける対応がディスク側で古い順に捨てられないようにする
+            await disk_result_cache.touch_raw_digest(raw_key)
+    return cache_key
+
+
+async def raw_digest_store(raw_key: str, cache_key: str) -> None:
+    if raw_digest_index.get(raw_key) == cache_key:
+        return
+    raw_digest_index.put(raw_key, cache_key)
+    if disk_result_cache is not None:
+        await disk_result_cache.put_raw_digest(raw_key, cache_key, RAW_DIGEST_INDEX_MAX_ENTRIES)
+
+
+async def stale_lookup(file_sha256: str, options_hash: str) -> Optional[tuple]:
+    """
+    現在の名前空間に結果がない元ファイルについて、旧名前空間の結果を (キャッシュキー, 結果) で返す
+    名前空間をまたぐ対応は永続化された元ファイルハッシュの対応表でのみ引ける
+    """
+    if not STALE_SERVE_ENABLED or disk_result_cache is None:
+        return None
+    stale = await disk_result_cache.find_stale(file_sha256, options_hash)
+    if stale is not None:
+        METRICS["stale_served"] += 1
+    return stale
+
+
+async def near_duplicate_lookup(key: str, fingerprint: int) -> Optional[dict]:
+    """
+    知覚ハッシュが近い（再保存・再圧縮された同一文書とみなせる）画像の結果を探す
+    OCRオプションが同じキーのみを対象とし、見つかった結果は完全一致キーにも登録する
+    """
+    options_hash = key.partition(":")[2]
+    for distance, candidate_key in perceptual_index.search(fingerprint, PHASH_MAX_DISTANCE):
+        if candidate_key.partition(":")[2] != options_hash:
+            continue
+        entry = await cache_lookup(candidate_key)
+        if entry is not None:
+            perceptual_index.hits += 1
+            METRICS["phash_hits"] += 1
+            logger.info(f"近似画像のキャッシュを利用: ハミング距離 {distance}")
+            result_cache.put(key, entry)
+            return entry
+    return None
+
+
+async def fetch_ocr_result(key: str, image_data: bytes, fingerprint: Optional[int] = None) -> dict:
+    """
+    SpaceでOCRを実行し、成功した結果をキャッシュに保存する
+    （ソフトエラーは例外になるため保存されない）
+    """
+    result = await call_huggingface_space_api(image_data)
+    if RESULT_CACHE_ENABLED:
+        await cache_store(key, {
+            "text": result.get("text", ""),
+            "confidence": result.get("confidence", 0.95),
+            "model_used": result.get("model_used", "dots.ocr (GOT-OCR2_0)"),
+        }, fingerprint)
+    return result
+
+
+async def load_ocr_result(key: str, image_data: bytes, fingerprint: Optional[int] = None) -> dict:
+    """
+    キャッシュに無い結果を読み込む
+    分散キャッシュ有効時は担当ノードに任せ、受け取った結果は自ノードのメモリにも置く（ホットキャッシュ）
+    担当ノードに届かなければ自ノードでOCRする
+    """
+    node = peer_group.owner(key) if peer_group is not None else None
+    if node is None:
+        return await fetch_ocr_result(key, image_data, fingerprint)
+    try:
+        entry = await peer_group.load(node, key, image_data, fingerprint)
+    except PeerUnavailable as e:
+        METRICS["peer_fallbacks"] += 1
+        logger.warning(f"担当ノード {node} に問い合わせできないため自ノードで処理します: {e}")
+        return await fetch_ocr_result(key, image_data, fingerprint)
+    METRICS["peer_loads"] += 1
+    if RESULT_CACHE_ENABLED:
+        result_cache.put(key, entry)
+    return entry
+
+
+gradio_client_pool: Optional[GradioClientPool] = None
+replica_pool: Optional[ReplicaPool] = None
+circuit_breakers = {
+    method: CircuitBreaker(
+        method,
+        failure_threshold=CIRCUIT_FAILURE_THRESHOLD,
+        reset_timeout=CIRCUIT_RESET_TIMEOUT,
+    )
+    for method in ("gradio_client", "http")
+}
+upstream_selection = {"last_method": None}
+upstream_latency = LatencyTracker(LATENCY_WINDOW_SIZE)
+retry_budget = RetryBudget(RETRY_BUDGET_RATIO, RETRY_BUDGET_MIN_PER_SECOND, RETRY_BUDGET_MAX_TOKENS)
+space_keep_warm = SpaceKeepWarm()
+# 複数ワーカー時はホストのメモリ予算を分け合い、共有の結果はディスクキャッシュ（SQLite WAL）に置く
+result_cache = ResultCache(RESULT_CACHE_MAX_BYTES // GATEWAY_WORKERS, RESULT_CACHE_TTL)
+single_flight = SingleFlight()
+raw_digest_index = RawDigestIndex(RAW_DIGEST_MEMORY_MAX_BYTES // GATEWAY_WORKERS)
+perceptual_index = PerceptualIndex(PHASH_INDEX_MAX_ENTRIES // GATEWAY_WORKERS)
+# stale な結果を返したワーカーが再計算するため、レートと待ち行列はワーカー間で分け合う
+stale_rewarmer = StaleRewarmer(REWARM_RATE_PER_MINUTE / GATEWAY_WORKERS, REWARM_QUEUE_MAX_BYTES // GATEWAY_WORKERS)
+shared_metrics: Optional[SharedMetrics] = SharedMetrics(METRICS_DB_PATH) if METRICS_DB_PATH else None
+# キープウォームはSpace単位の処理なので、複数ワーカーでも1つのワーカーだけで動かす
+keep_warm_leader: Optional[LeaderService] = (
+    LeaderService("keep_warm", space_keep_warm, shared_metrics, LEADER_LEASE_SECONDS)
+    if shared_metrics is not None else None
+)
+peer_group: Optional[PeerGroup] = (
+    PeerGroup(CACHE_SELF_URL, CACHE_PEERS, CACHE_PEER_VNODES)
+    if CACHE_PEERS and CACHE_SELF_URL else None
+)
+disk_result_cache: Optional[DiskResultCache] = (
+    DiskResultCache(RESULT_CACHE_DB_PATH, RESULT_CACHE_DB_MAX_BYTES, RESULT_CACHE_TTL)
+    if RESULT_CACHE_DB_PATH else None
+)
+# UPSTREAM_MAX_CONCURRENCY はゲートウェイ全体の上限なのでワーカー数で割る
+upstream_limiter = UpstreamLimiter(max(1, -(-UPSTREAM_MAX_CONCURRENCY // GATEWAY_WORKERS)))
+http_session: Optional[aiohttp.ClientSession] = None
+
+
+def create_http_session() -> aiohttp.ClientSession:
+    """
+    アプリ全体で共有する keep-alive 付き aiohttp セッションを生成
+    DNS・TCP・TLSのセットアップをリクエストごとに繰り返さない
+    """
+    connector = aiohttp.TCPConnector(
+        limit=HTTP_POOL_LIMIT,
+        limit_per_host=HTTP_POOL_LIMIT_PER_HOST,
+        keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT,
+        ttl_dns_cache=HTTP_DNS_CACHE_TTL,
+        use_dns_cache=True,
+    )
+    return aiohttp.ClientSession(connector=connector)
+
+
+def get_http_session() -> aiohttp.ClientSession:
+    """共有セッションを返す（lifespan外から呼ばれた場合は遅延生成）"""
+    global http_session
+    if http_session is None or http_session.closed:
+        http_session = create_http_session()
+    return http_session
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """アプリケーションのライフサイクル管理（共有リソースの生成と破棄）"""
+    global gradio_client_pool, replica_pool, http_session
+
+    if peer_group is not None and not CACHE_PEER_TOKEN:
+        # トークン無しでは内部APIが誰からでも呼べ、任意のキーで上流のOCRを起動できてしまう
+        raise RuntimeError("CACHE_PEERS を設定する場合は CACHE_PEER_TOKEN も設定してください")
+
+    http_session = create_http_session()
+    if HUGGINGFACE_SPACE_URLS:
+        replica_pool = ReplicaPool(HUGGINGFACE_SPACE_URLS, HUGGINGFACE_API_NAME, REPLICA_BALANCING)
+
+    if HUGGINGFACE_SPACE_NAME:
+        gradio_client_pool = GradioClientPool(
+            HUGGINGFACE_SPACE_NAME,
+            size=GRADIO_CLIENT_POOL_SIZE,
+            health_check_interval=GRADIO_CLIENT_HEALTH_CHECK_INTERVAL,
+            max_workers=UPSTREAM_MAX_CONCURRENCY,
+            connect_timeout=GRADIO_CLIENT_CONNECT_TIMEOUT,
+        )
+        gradio_client_pool.start()
+
+    if PHASH_ENABLED and disk_result_cache is not None:
+        for key, fingerprint in await disk_result_cache.load_fingerprints(perceptual_index.max_entries):
+            perceptual_index.add(fingerprint, key)
+        logger.info(f"知覚ハッシュ索引を復元しました: {len(perceptual_index)}件")
+
+    if KEEP_WARM_ENABLED and configured_upstream_methods():
+        if keep_warm_leader is not None:
+            keep_warm_leader.start()
+        else:
+            space_keep_warm.start()
+
+    if STALE_SERVE_ENABLED and configured_upstream_methods():
+        stale_rewarmer.start()
+
+    if shared_metrics is not None:
+        shared_metrics.start()
 
-# HuggingFace Space設定
-HUGGINGFACE_SPACE_URL = os.getenv("HUGGINGFACE_SPACE_URL", "")
-HUGGINGFACE_SPACE_NAME = os.getenv("HUGGINGFACE_SPACE_NAME", "")
+    preprocess_pool.start()
+
+    yield
+
+    await preprocess_pool.close()
+
+    if shared_metrics is not None:
+        await shared_metrics.stop()
+    await stale_rewarmer.stop()
+    if keep_warm_leader is not None:
+        await keep_warm_leader.stop()
+    await space_keep_warm.stop()
+
+    if gradio_client_pool is not None:
+        await gradio_client_pool.close()
+        gradio_client_pool = None
+
+    replica_pool = None
+    if http_session is not None:
+        await http_session.close()
+        http_session = None
 
-# HuggingFace Space接続確認
-if HUGGINGFACE_SPACE_URL or HUGGINGFACE_SPACE_NAME:
-    logger.info(f"HuggingFace Space設定済み: {HUGGINGFACE_SPACE_NAME or HUGGINGFACE_SPACE_URL}")
-else:
-    logger.warning("HuggingFace Space設定がありません - デモモードで動作します")
 
 app = FastAPI(
     title="OCR API Gateway",
     description="dots.ocr powered OCR service via HuggingFace Space",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan
 )
 
 # CORS設定
@@ -57,153 +2542,663 @@ class OCRResponse(BaseModel):
     processing_time: float
     model: str = "dots.ocr (GOT-OCR2_0)"
     model_used: Optional[str] = None
+    cache_hit: bool = False
+    stale: bool = False
 
 class HealthResponse(BaseModel):
     status: str
     message: str
     timestamp: float
 
+def _default_spool_dir() -> str:
+    """メモリ上のtmpfs（/dev/shm）が使えればそこをスプール先にする"""
+    if os.path.isdir("/dev/shm") and os.access("/dev/shm", os.W_OK):
+        return "/dev/shm"
+    return tempfile.gettempdir()
+
+
+GRADIO_SPOOL_DIR = os.getenv("GRADIO_SPOOL_DIR") or _default_spool_dir()
+
+
+@contextmanager
+def spooled_image_file(image_data: bytes):
+    """
+    gradio_client に渡すための画像ファイルをスプールに作成し、パスを返す
+    tmpfs上ではディスクI/Oが発生せず、終了時（例外・キャンセル含む）に必ず削除される
+    """
+    fd, path = tempfile.mkstemp(suffix='.jpg', prefix='ocr-', dir=GRADIO_SPOOL_DIR)
+    try:
+        with os.fdopen(fd, 'wb') as spool_file:
+            spool_file.write(image_data)
+        yield path
+    finally:
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+
+def gradio_file_arg(path: str):
+    """gradio_client のバージョン差を吸収してファイル引数を作る"""
+    try:
+        from gradio_client import handle_file
+        return handle_file(path)
+    except ImportError:
+        pass
+    try:
+        from gradio_client import file
+        return file(path)
+    except ImportError:
+        # 旧バージョンはファイルパスをそのまま受け付ける
+        return path
+
+
+class UpstreamRoutes:
+    """
+    1つの要求の一次呼び出しとヘッジが使った方式・レプリカ
+    ヘッジはここに載っていない経路だけに送り、同じ送り先へ複製しない
+    """
+
+    def __init__(self):
+        self.methods: list = []
+        self.replicas: list = []
+
+    def pending_replica_choices(self) -> int:
+        """HTTP方式で呼び出したが、まだレプリカを選んでいない（同時実行枠の待ち）件数"""
+        return max(0, self.methods.count("http") - len(self.replicas))
+
+
+def normalize_space_output(output, model_used: str, output_dir: Optional[str] = None) -> dict:
+    """
+    Spaceの出力を結果の辞書にそろえる
+    /predict（gradio_interface）は (テキスト, メタデータ, 結果JSON文字列) の3出力で、結果JSONを優先して使う
+    gradio_client 0.7 は gr.JSON の出力（/ocr_api）を output_dir 内の一時ファイルのパスで返すため、その中身を読む
+    """
+    if isinstance(output, (list, tuple)):
+        if not output:
+            raise UpstreamError("無効なAPI応答形式")
+        if len(output) >= 3 and isinstance(output[2], str):
+            parsed = _parse_json_object(output[2])
+            if parsed is not None:
+                return parsed
+        return normalize_space_output(output[0], model_used, output_dir)
+    if isinstance(output, dict):
+        return output
+    if isinstance(output, str):
+        if output_dir and output.endswith(".json") and _is_within(output, output_dir) and os.path.isfile(output):
+            try:
+                with open(output, encoding="utf-8") as f:
+                    parsed = _parse_json_object(f.read())
+            finally:
+                with suppress(OSError):
+                    os.remove(output)
+            if parsed is not None:
+                return parsed
+        parsed = _parse_json_object(output)
+        if parsed is not None:
+            return parsed
+    return {
+        "text": str(output),
+        "confidence": 0.95,
+        "model_used": model_used
+    }
+
+
+def _is_within(path: str, directory: str) -> bool:
+    directory = os.path.realpath(directory)
+    return os.path.commonpath([os.path.realpath(path), directory]) == directory
+
+
+def _parse_json_object(text: str) -> Optional[dict]:
+    try:
+        value = json.loads(text)
+    except ValueError:
+        return None
+    return value if isinstance(value, dict) else None
+
+
+async def predict_via_gradio_client(image_data: bytes, budget: UpstreamBudget,
+                                    routes: Optional[UpstreamRoutes] = None) -> dict:
+    """
+    方法1: gradio_client の共有プール経由でOCR処理
+    送り先は HUGGINGFACE_SPACE_NAME の1つだけなので routes にはレプリカを記録しない
+    """
+    if gradio_client_pool is None:
+        raise Exception("Gradio Client プールが初期化されていません")
+
+    # API呼び出し（共有プールの接続でジョブを投入し、完了をイベントループ上で待機）
+    # 画像はtmpfs上のスプールに置き、例外・キャンセル時も必ず削除する
+    async with upstream_limiter.slot():
+        async with gradio_client_pool.acquire() as client:
+            with spooled_image_file(image_data) as image_path:
+                job = client.submit(
+                    gradio_file_arg(image_path),
+                    api_name=HUGGINGFACE_API_NAME
+                )
+                try:
+                    # gradio_client自体にはタイムアウトが無いため総時間の予算で打ち切る
+                    result = await asyncio.wait_for(asyncio.wrap_future(job.future), budget.total)
+                except (asyncio.CancelledError, asyncio.TimeoutError):
+                    job.cancel()
+                    if not job.future.done():
+                        # 受信中のジョブは止められず、Spaceも処理を続ける
+                        METRICS["upstream_abandoned"] += 1
+                        mark_upstream_abandoned()
+                        gradio_client_pool.retire(client)
+                    raise
+
+    return normalize_space_output(result, "huggingface_space", client.output_dir)
+
+
+async def _upload_and_predict(replica: "UpstreamReplica", session: aiohttp.ClientSession,
+                              image_data: bytes, timeout: aiohttp.ClientTimeout) -> list:
+    file_data = await replica.client.upload(session, image_data, timeout=timeout)
+    return await replica.client.predict(session, [file_data], timeout=timeout)
+
+
+async def predict_via_http(image_data: bytes, budget: UpstreamBudget,
+                           routes: Optional[UpstreamRoutes] = None) -> dict:
+    """
+    方法2: Gradioキュープロトコルを直接呼び出し（gradio_client不要）
+    routes を渡すと、そこに載っているレプリカを避けて選び、選んだレプリカを記録する
+    （一次呼び出しとヘッジで共有し、同じレプリカに複製を送らないため）
+    """
+    if replica_pool is None:
+        raise Exception("レプリカプールが初期化されていません")
+
+    async with upstream_limiter.slot():
+        replica = replica_pool.choose(exclude=tuple(routes.replicas) if routes is not None else ())
+        if routes is not None:
+            routes.replicas.append(replica)
+        async with replica_pool.track(replica):
+            # 画像はマルチパートで1回だけ送信し、predict ではパスを参照する
+            session = get_http_session()
+            output_data = await asyncio.wait_for(
+                _upload_and_predict(replica, session, image_data, budget.client_timeout()),
+                budget.total
+            )
+
+    # Gradio APIレスポンスの正規化
+    return normalize_space_output(output_data, "huggingface_space_http")
+
+
+UPSTREAM_METHODS = {
+    "gradio_client": predict_via_gradio_client,
+    "http": predict_via_http,
+}
+
+
+def configured_upstream_methods() -> list:
+    """設定済みの呼び出し方式を優先順に返す"""
+    methods = []
+    if HUGGINGFACE_SPACE_NAME:
+        methods.append("gradio_client")
+    if HUGGINGFACE_SPACE_URLS:
+        methods.append("http")
+    return methods
+
+
+def classify_upstream_error(error: Exception) -> UpstreamError:
+    """任意の例外を UpstreamError に分類する"""
+    if isinstance(error, UpstreamError):
+        return error
+    if isinstance(error, asyncio.TimeoutError):
+        return UpstreamError("タイムアウトしました", UpstreamError.TIMEOUT)
+    # gradio_client はキュー満杯時に QueueError を送出する
+    if type(error).__name__ == "QueueError" or "queue is full" in str(error).lower():
+        return UpstreamError(f"Spaceのキューが満杯です: {error}", UpstreamError.QUEUE_FULL)
+    return UpstreamError(str(error) or type(error).__name__, UpstreamError.TRANSPORT)
+
+
+# Spaceの process_image が失敗時に返すテキストの先頭（huggingface-space/app.py）
+SPACE_ERROR_TEXT_PREFIX = "[エラー]"
+
+
+def check_soft_error(result: dict) -> None:
+    """
+    Spaceの process_image は失敗時も例外を投げず model_used: "error" を返すため、
+    成功扱いにしないよう UpstreamError に変換する
+    テキストしか返さないエンドポイントでは、エラー時のテキスト（"[エラー] ..."）で判断する
+    """
+    text = result.get("text")
+    if result.get("model_used") == "error" or result.get("error") or (
+        isinstance(text, str) and text.startswith(SPACE_ERROR_TEXT_PREFIX)
+    ):
+        METRICS[f"upstream_errors_{UpstreamError.SOFT_ERROR}"] += 1
+        raise UpstreamError(
+            f"Spaceのモデル処理エラー: {result.get('error') or result.get('text')}",
+            UpstreamError.SOFT_ERROR
+        )
+
+
+async def _call_with_breaker(method: str, image_data: bytes, budget: UpstreamBudget,
+                             routes: Optional[UpstreamRoutes] = None) -> dict:
+    """サーキットブレーカーに結果を記録しながら1つの方式を呼び出す"""
+    breaker = circuit_breakers[method]
+    if routes is not None:
+        routes.methods.append(method)
+    try:
+        result = await UPSTREAM_METHODS[method](image_data, budget, routes)
+    except asyncio.CancelledError:
+        breaker.record_cancelled()
+        raise
+    except Exception as e:
+        error = classify_upstream_error(e)
+        if error.kind == UpstreamError.TIMEOUT and not isinstance(e, UpstreamError):
+            error = UpstreamError(f"タイムアウトしました (総時間予算 {budget.total:.1f}秒)", error.kind)
+        METRICS[f"upstream_errors_{error.kind}"] += 1
+        # モデル処理エラーは呼び出し方式の故障ではないためブレーカーには数えない
+        if error.kind == UpstreamError.SOFT_ERROR:
+            breaker.record_success()
+        else:
+            breaker.record_failure()
+        raise error from e
+    breaker.record_success()
+    check_soft_error(result)
+    return result
+
+
+def _combine_errors(errors: list) -> UpstreamError:
+    """複数方式のエラーを1つにまとめる（分類は最後に発生したエラーに従う）"""
+    if not errors:
+        return UpstreamError("利用可能な呼び出し方式がありません (サーキットオープン)", UpstreamError.CIRCUIT_OPEN)
+    kind = errors[-1][1].kind
+    detail = "; ".join(f"{method}: {error}" for method, error in errors)
+    return UpstreamError(f"HuggingFace Space APIの呼び出しに失敗しました ({detail})", kind)
+
+
+async def _call_sequential(image_data: bytes, budget: UpstreamBudget,
+                           routes: Optional[UpstreamRoutes] = None) -> dict:
+    """優先順に方式を試し、ブレーカーが開いている方式は待たずにスキップ"""
+    errors = []
+    skipped = []
+    for method in configured_upstream_methods():
+        if not circuit_breakers[method].allow_request():
+            skipped.append(method)
+            continue
+        try:
+            result = await _call_with_breaker(method, image_data, budget, routes)
+            upstream_selection["last_method"] = method
+            return result
+        except UpstreamError as e:
+            logger.warning(f"{method} 方式エラー ({e.kind}): {e}")
+            errors.append((method, e))
+            # モデル処理エラーは別の方式でも同じSpaceで再発するため、次の方式には送らない
+            if e.kind == UpstreamError.SOFT_ERROR:
+                break
+
+    if not errors:
+        errors = [
+            (method, UpstreamError("サーキットオープン", UpstreamError.CIRCUIT_OPEN)) for method in skipped
+        ]
+    raise _combine_errors(errors)
+
+
+async def _call_race(image_data: bytes, budget: UpstreamBudget,
+                     routes: Optional[UpstreamRoutes] = None) -> dict:
+    """利用可能な方式を同時に呼び出し、最初に成功した結果を採用して残りはキャンセル"""
+    tasks = {}
+    errors = []
+    for method in configured_upstream_methods():
+        if circuit_breakers[method].allow_request():
+            tasks[asyncio.create_task(_call_with_breaker(method, image_data, budget, routes))] = method
+
+    try:
+        pending = set(tasks)
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                method = tasks[task]
+                if task.exception() is None:
+                    upstream_selection["last_method"] = method
+                    return task.result()
+                logger.warning(f"{method} 方式エラー: {task.exception()}")
+                errors.append((method, task.exception()))
+    finally:
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+
+    raise _combine_errors(errors)
+
+
+async def _call_primary(image_data: bytes, budget: UpstreamBudget,
+                        routes: Optional[UpstreamRoutes] = None) -> dict:
+    if UPSTREAM_STRATEGY == "race":
+        return await _call_race(image_data, budget, routes)
+    return await _call_sequential(image_data, budget, routes)
+
+
+def hedge_delay() -> Optional[float]:
+    """ヘッジを送るまでの待ち時間（サンプル不足の間はヘッジしない）"""
+    if len(upstream_latency) < HEDGE_MIN_SAMPLES:
+        return None
+    return max(HEDGE_MIN_DELAY, upstream_latency.percentile(HEDGE_PERCENTILE))
+
+
+def _hedge_method(routes: UpstreamRoutes) -> Optional[str]:
+    """
+    ヘッジの送り先となる方式を選ぶ（一次呼び出しと同じ送り先しか無ければ None）
+    HTTP方式は、一次呼び出しが使っている（これから選ぶ）レプリカ以外に稼働中のレプリカがある場合だけ使い、
+    gradio_client 方式は一次呼び出しが使っていない場合だけ使う
+    """
+    methods = configured_upstream_methods()
+    if "http" in methods and replica_pool is not None:
+        free = sum(1 for r in replica_pool.replicas if not r.ejected and r not in routes.replicas)
+        if free > routes.pending_replica_choices():
+            return "http"
+    if "gradio_client" in methods and "gradio_client" not in routes.methods:
+        return "gradio_client"
+    return None
+
+
+async def _call_hedged(image_data: bytes, budget: UpstreamBudget) -> dict:
+    """
+    一次呼び出しが hedge_delay() 以内に終わらなければ別経路へ複製を送り、
+    先に成功した方を採用して残りはキャンセルする
+    """
+    delay = hedge_delay()
+    # 一次呼び出しとヘッジが使った経路（ヘッジは一次呼び出しの経路を避ける）
+    routes = UpstreamRoutes()
+    primary = asyncio.create_task(_call_primary(image_data, budget, routes))
+    tasks = {primary: "primary"}
+    errors = []
+
+    try:
+        if delay is not None:
+            done, _ = await asyncio.wait({primary}, timeout=delay)
+            method = _hedge_method(routes) if not done else None
+            if method and circuit_breakers[method].allow_request():
+                METRICS["hedges_fired"] += 1
+                logger.info(f"ヘッジリクエスト送信: {method} ({delay:.2f}秒経過)")
+                tasks[asyncio.create_task(_call_with_breaker(method, image_data, budget, routes))] = "hedge"
+
+        pending = set(tasks)
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    if tasks[task] == "hedge":
+                        METRICS["hedge_wins"] += 1
+                    elif len(tasks) > 1:
+                        METRICS["hedge_primary_wins"] += 1
+                    return task.result()
+                errors.append(task.exception())
+    finally:
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+
+    raise errors[0]
+
+
+def image_pixels(image_data: bytes) -> Optional[int]:
+    """画像ヘッダーのみを読んでピクセル数を返す（デコードはしない）"""
+    try:
+        with Image.open(io.BytesIO(image_data)) as image:
+            return image.size[0] * image.size[1]
+    except Exception:
+        return None
+
+
+def upstream_budget(pixels: Optional[int] = None) -> UpstreamBudget:
+    """
+    直近レイテンシのp99と画像サイズから呼び出しの時間予算を決める
+    中央値より大きい画像はピクセル比に応じて総時間を延ばし、
+    正当に遅い大きな画像を打ち切らないようにする
+    """
+    p99 = upstream_latency.percentile(99)
+    if p99 is None or len(upstream_latency) < UPSTREAM_TIMEOUT_MIN_SAMPLES:
+        total = UPSTREAM_TIMEOUT_DEFAULT
+    else:
+        total = p99 * UPSTREAM_TIMEOUT_MULTIPLIER
+        median_pixels = upstream_latency.median_pixels()
+        if pixels and median_pixels:
+            total *= max(1.0, pixels / median_pixels)
+        total = min(UPSTREAM_TIMEOUT_MAX, max(UPSTREAM_TIMEOUT_MIN, total))
+
+    return UpstreamBudget(
+        connect=UPSTREAM_CONNECT_TIMEOUT,
+        first_byte=UPSTREAM_FIRST_BYTE_TIMEOUT,
+        total=total
+    )
+
+
+def retry_backoff(attempt: int) -> float:
+    """フルジッター付き指数バックオフ"""
+    return random.uniform(0, min(RETRY_BACKOFF_MAX, RETRY_BACKOFF_BASE * (2 ** attempt)))
+
+
 async def call_huggingface_space_api(image_data: bytes) -> dict:
     """
     HuggingFace Space APIを呼び出してOCR処理を実行
+    UPSTREAM_STRATEGY=sequential: gradio_client → HTTP の順に試行
+    UPSTREAM_STRATEGY=race: 両方式を同時に呼び出し、先に成功した方を採用
+    HEDGE_ENABLED=true: 遅い呼び出しには別レプリカ/別方式へヘッジを送る
     """
     try:
-        # 方法1: gradio_clientを使用（推奨）
-        if HUGGINGFACE_SPACE_NAME:
+        METRICS["upstream_requests"] += 1
+        retry_budget.record_request()
+        pixels = image_pixels(image_data)
+        budget = upstream_budget(pixels)
+        attempt = 0
+
+        while True:
+            started_at = time.monotonic()
             try:
-                from gradio_client import file
-                client = Client(HUGGINGFACE_SPACE_NAME)
-                
-                # 画像を一時ファイルに保存
-                import tempfile
-                with tempfile.NamedTemporaryFile(suffix='.png', delete=False) as tmp_file:
-                    tmp_file.write(image_data)
-                    tmp_image_path = tmp_file.name
-                
-                # API呼び出し（file()関数を使用）
-                result = client.predict(
-                    file(tmp_image_path),
-                    api_name="/predict"
-                )
-                
-                # 一時ファイルを削除
-                import os
-                os.unlink(tmp_image_path)
-                
-                # 結果の正規化
-                if isinstance(result, dict):
-                    return result
-                elif isinstance(result, str):
-                    # JSON文字列の場合はパース
-                    import json
-                    try:
-                        return json.loads(result)
-                    except:
-                        return {
-                            "text": result,
-                            "confidence": 0.95,
-                            "model_used": "huggingface_space"
-                        }
+                if HEDGE_ENABLED:
+                    result = await _call_hedged(image_data, budget)
                 else:
-                    return {
-                        "text": str(result),
-                        "confidence": 0.95,
-                        "model_used": "huggingface_space"
-                    }
-                    
-            except Exception as gradio_error:
-                logger.warning(f"Gradio Client エラー: {gradio_error}")
-                # 方法2にフォールバック
-                pass
-        
-        # 方法2: 直接HTTP API呼び出し
-        if HUGGINGFACE_SPACE_URL:
-            try:
-                # 画像をbase64エンコード
-                import base64
-                image_b64 = base64.b64encode(image_data).decode('utf-8')
-                
-                async with aiohttp.ClientSession() as session:
-                    # Gradio API エンドポイント修正（正しいパス）
-                    api_url = f"{HUGGINGFACE_SPACE_URL.rstrip('/')}/call/predict"
-                    
-                    # Gradio API の正しい形式
-                    payload = {
-                        "data": [{
-                            "path": None,
-                            "url": f"data:image/jpeg;base64,{image_b64}",
-                            "size": len(image_data),
-                            "orig_name": "uploaded_image.jpg",
-                            "mime_type": "image/jpeg",
-                            "is_stream": False,
-                            "meta": {}
-                        }]
-                    }
-                    
-                    async with session.post(
-                        api_url,
-                        json=payload,
-                        headers={"Content-Type": "application/json"},
-                        timeout=aiohttp.ClientTimeout(total=60)
-                    ) as response:
-                        
-                        if response.status == 200:
-                            result_data = await response.json()
-                            
-                            # Gradio APIレスポンスの正規化
-                            if "data" in result_data and len(result_data["data"]) > 0:
-                                api_result = result_data["data"][0]
-                                
-                                if isinstance(api_result, dict):
-                                    return api_result
-                                else:
-                                    return {
-                                        "text": str(api_result),
-                                        "confidence": 0.95,
-                                        "model_used": "huggingface_space_http"
-                                    }
-                            else:
-                                raise Exception("無効なAPI応答形式")
-                        else:
-                            raise Exception(f"HTTP エラー: {response.status}")
-                            
-            except Exception as http_error:
-                logger.warning(f"HTTP API エラー: {http_error}")
-                # デモモードにフォールバック
-                pass
-        
-        # すべての方法で失敗した場合のフォールバック
-        raise Exception("HuggingFace Space APIの呼び出しに失敗しました")
-        
+                    result = await _call_primary(image_data, budget)
+                break
+            except UpstreamError as e:
+                # リトライ可能なエラーのみ、回数上限とグローバルなリトライ予算の範囲で再試行
+                if not e.retryable or attempt >= UPSTREAM_MAX_RETRIES or not retry_budget.try_spend():
+                    raise
+                attempt += 1
+                METRICS["upstream_retries"] += 1
+                delay = retry_backoff(attempt)
+                logger.warning(f"上流エラー ({e.kind}) - {delay:.2f}秒後にリトライします ({attempt}/{UPSTREAM_MAX_RETRIES})")
+                await asyncio.sleep(delay)
+
+        upstream_latency.record(time.monotonic() - started_at, pixels)
+        space_keep_warm.record_success()
+        return result
+
     except Exception as e:
+        METRICS["upstream_failures"] += 1
         logger.error(f"HuggingFace Space API呼び出しエラー: {e}")
         raise e
 
-def optimize_image(image_data: bytes, max_size: tuple = (1920, 1920)) -> bytes:
+def preprocess_image(image_data: bytes, max_size: tuple = (PREPROCESS_MAX_SIZE, PREPROCESS_MAX_SIZE),
+                     with_fingerprint: bool = False) -> PreprocessedImage:
+    """
+    現在の前処理設定で画像を最適化する（実体は image_preprocess.preprocess_image）
+    with_fingerprint=True の場合は縮小済みの画像から知覚ハッシュも計算する
+    """
+    return image_preprocess.preprocess_image(
+        image_data, max_size, PREPROCESS_JPEG_QUALITY, PREPROCESS_JPEG_DRAFT,
+        PHASH_HASH_SIZE if with_fingerprint else None
+    )
+
+
+def optimize_image(image_data: bytes, max_size: tuple = (PREPROCESS_MAX_SIZE, PREPROCESS_MAX_SIZE)) -> bytes:
+    """画像を最適化してメモリ使用量を削減"""
+    return preprocess_image(image_data, max_size).data
+
+
+class PreprocessUnavailable(Exception):
+    """画像最適化を受け付けられない・時間内に終わらなかった（status_code で応答を決める）"""
+
+    def __init__(self, message: str, status_code: int):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class PreprocessPool:
+    """
+    画像最適化（デコード・LANCZOS縮小・JPEG再エンコード）をイベントループの外で実行する
+    プロセスプールならCPU処理が複数コアに広がり、その間もイベントループはI/Oを処理できる
+    実行中＋待機中の件数を max_queue で制限し、1件ごとに timeout 秒の期限を設ける
+    """
+
+    def __init__(self, mode: str, workers: int, max_queue: int, timeout: float):
+        self.mode = mode
+        self.workers = workers
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self._executor = None
+        self._pending = 0
+        self.completed = 0
+        self.rejected = 0
+        self.timeouts = 0
+        self.restarts = 0
+
+    def _create_executor(self):
+        if self.mode == "process":
+            # fork はイベントループ・スレッドを抱えたまま複製するため spawn で起動する
+            return ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("spawn"))
+        return ThreadPoolExecutor(self.workers, thread_name_prefix="preprocess")
+
+    def start(self) -> None:
+        if self.mode not in ("process", "thread") or self._executor is not None:
+            return
+        self.workers = self.workers or preprocess_worker_count()
+        self._executor = self._create_executor()
+        if self.mode == "process":
+            # 子プロセスの起動（モジュールの読み込み）を最初のリクエストに負わせない
+            for _ in range(self.workers):
+                self._executor.submit(os.getpid)
+        logger.info(f"画像最適化プールを起動しました: {self.mode} × {self.workers}")
+
+    async def close(self) -> None:
+        if self._executor is not None:
+            executor, self._executor = self._executor, None
+            await asyncio.to_thread(executor.shutdown, wait=True, cancel_futures=True)
+
+    def _release(self, loop: asyncio.AbstractEventLoop) -> None:
+        # 期限切れで待つのをやめても、実際に処理が終わるまで枠は解放しない（投入し続けて詰まらせない）
+        loop.call_soon_threadsafe(self._done)
+
+    def _done(self) -> None:
+        self._pending -= 1
+
+    async def run(self, image_data: bytes, with_fingerprint: bool = False) -> PreprocessedImage:
+        if self._executor is None:
+            return preprocess_image(image_data, with_fingerprint=with_fingerprint)
+        if self._pending >= self.max_queue:
+            self.rejected += 1
+            METRICS["preprocess_rejected"] += 1
+            raise PreprocessUnavailable("画像処理が混み合っています。しばらくしてから再度お試しください", 503)
+
+        loop = asyncio.get_running_loop()
+        executor = self._executor
+        try:
+            # 子プロセスが読み込むのは image_preprocess だけ（main を丸ごと読み込ませない）
+            future = executor.submit(
+                image_preprocess.preprocess_image, image_data, (PREPROCESS_MAX_SIZE, PREPROCESS_MAX_SIZE),
+                PREPROCESS_JPEG_QUALITY, PREPROCESS_JPEG_DRAFT, PHASH_HASH_SIZE if with_fingerprint else None
+            )
+        except BrokenProcessPool:
+            self._restart(executor)
+            raise PreprocessUnavailable("画像処理プロセスが停止したため再起動しました", 503)
+        self._pending += 1
+        future.add_done_callback(lambda _: self._release(loop))
+        try:
+            result = await asyncio.wait_for(asyncio.wrap_future(future), self.timeout)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            METRICS["preprocess_timeouts"] += 1
+            raise PreprocessUnavailable(f"画像処理が{self.timeout:.0f}秒以内に終わりませんでした", 504)
+        except BrokenProcessPool:
+            # 子プロセスが異常終了した（メモリ不足でのkillなど）
+            self._restart(executor)
+            raise PreprocessUnavailable("画像処理プロセスが停止したため再起動しました", 503)
+        self.completed += 1
+        return result
+
+    def _restart(self, broken) -> None:
+        """
+        停止したプールを作り直す
+        同じプールで処理中だった全ジョブが BrokenProcessPool を受け取るため、
+        既に作り直し済み（self._executor が別物）なら何もしない
+        """
+        if self._executor is not broken:
+            return
+        logger.error("画像最適化プールが停止したため作り直します")
+        self.restarts += 1
+        self._executor = self._create_executor()
+        broken.shutdown(wait=False, cancel_futures=True)
+
+    def stats(self) -> dict:
+        return {
+            "mode": self.mode if self._executor is not None else "inline",
+            "workers": self.workers,
+            "pending": self._pending,
+            "max_queue": self.max_queue,
+            "timeout": self.timeout,
+            "completed": self.completed,
+            "rejected": self.rejected,
+            "timeouts": self.timeouts,
+            "restarts": self.restarts,
+        }
+
+
+preprocess_pool = PreprocessPool(PREPROCESS_EXECUTOR, PREPROCESS_WORKERS, PREPROCESS_MAX_QUEUE, PREPROCESS_TIMEOUT)
+
+
+class ClientDisconnected(Exception):
+    """OCR処理中にクライアントが切断した"""
+
+
+# 切断時に取り消せなかった上流ジョブの記録先（run_until_disconnected が要求ごとに用意する）
+_abandoned_upstream: contextvars.ContextVar[Optional[list]] = contextvars.ContextVar(
+    "abandoned_upstream", default=None
+)
+
+
+def mark_upstream_abandoned() -> None:
+    """上流ジョブを取り消せず、Space側で処理が続くことを記録する"""
+    abandoned = _abandoned_upstream.get()
+    if abandoned is not None:
+        abandoned.append(True)
+
+
+async def run_until_disconnected(request: Request, coro):
     """
-    画像を最適化してメモリ使用量を削減
-    Railway $5プランのメモリ制限(512MB)を考慮
+    クライアントの切断を監視しながらコルーチンを実行する
+    切断を検知したら上流の処理をキャンセルし、同時実行枠も即座に解放する
+    取り消せなかった上流ジョブ（gradio_client 経由）は cancelled_work_seconds に数えない
     """
+    abandoned: list = []
+    token = _abandoned_upstream.set(abandoned)
     try:
-        image = Image.open(io.BytesIO(image_data))
-        
-        # 画像サイズを制限
-        if image.size[0] > max_size[0] or image.size[1] > max_size[1]:
-            image.thumbnail(max_size, Image.Resampling.LANCZOS)
-            logger.info(f"画像をリサイズしました: {image.size}")
-        
-        # RGB形式に変換（必要に応じて）
-        if image.mode not in ['RGB', 'L']:
-            image = image.convert('RGB')
-        
-        # 最適化された画像をバイト形式で返す
-        output = io.BytesIO()
-        image.save(output, format='JPEG', quality=85, optimize=True)
-        return output.getvalue()
-        
-    except Exception as e:
-        logger.error(f"画像最適化エラー: {e}")
-        return image_data
+        task = asyncio.create_task(coro)
+    finally:
+        _abandoned_upstream.reset(token)
+    started_at = time.monotonic()
+    try:
+        while True:
+            done, _ = await asyncio.wait({task}, timeout=DISCONNECT_POLL_INTERVAL)
+            if done:
+                return task.result()
+            if await request.is_disconnected():
+                task.cancel()
+                try:
+                    await task
+                except (asyncio.CancelledError, Exception):
+                    pass
+                METRICS["cancelled_requests"] += 1
+                if abandoned:
+                    # gradio_client 経由のジョブは止められず、GPU処理は削減できていない
+                    METRICS["cancelled_upstream_abandoned"] += 1
+                else:
+                    METRICS["cancelled_work_seconds"] += time.monotonic() - started_at
+                raise ClientDisconnected()
+    finally:
+        if not task.done():
+            task.cancel()
+
 
 @app.get("/", response_model=HealthResponse)
 async def root():
@@ -224,7 +3219,7 @@ async def health_check():
     )
 
 @app.post("/api/v1/ocr/process", response_model=OCRResponse)
-async def process_ocr(file: UploadFile = File(...)):
+async def process_ocr(request: Request, response: Response, file: UploadFile = File(...)):
     """
     OCR処理メインエンドポイント
     HuggingFace Space経由でdots.ocrモデルを使用
@@ -233,7 +3228,7 @@ async def process_ocr(file: UploadFile = File(...)):
     
     try:
         # 設定確認（HuggingFace Spaceまたはデモモード）
-        has_hf_config = bool(HUGGINGFACE_SPACE_URL or HUGGINGFACE_SPACE_NAME)
+        has_hf_config = bool(HUGGINGFACE_SPACE_URLS or HUGGINGFACE_SPACE_NAME)
         if not has_hf_config:
             logger.info("HuggingFace Space未設定 - デモモードで動作します")
         
@@ -246,7 +3241,7 @@ async def process_ocr(file: UploadFile = File(...)):
         
         # ファイルサイズ制限（10MB）
         content = await file.read()
-        if len(content) > 10 * 1024 * 1024:
+        if len(content) > MAX_UPLOAD_BYTES:
             raise HTTPException(
                 status_code=400,
                 detail="ファイルサイズは10MB以下にしてください"
@@ -254,8 +3249,71 @@ async def process_ocr(file: UploadFile = File(...)):
         
         logger.info(f"画像処理開始: {file.filename}, サイズ: {len(content)} bytes")
         
-        # 画像最適化
-        optimized_image = optimize_image(content)
+        options = ocr_options()
+        file_sha256 = hashlib.sha256(content).hexdigest()
+        raw_key = RawDigestIndex.key(file_sha256, options_digest(options))
+        
+        # 同じファイルの再アップロードなら、画像最適化（デコード・リサイズ・再エンコード）を
+        # 行わずに元ファイルのハッシュから直接キャッシュ済みの結果を返す
+        if has_hf_config and RESULT_CACHE_ENABLED:
+            known_cache_key = await raw_digest_lookup(raw_key)
+            cached = await cache_lookup(known_cache_key) if known_cache_key else None
+            if cached is not None:
+                METRICS["preprocess_skipped"] += 1
+                processing_time = time.time() - start_time
+                logger.info(f"キャッシュヒット（最適化省略）: {file.filename} ({processing_time:.3f}秒)")
+                response.headers["ETag"] = result_etag(known_cache_key)
+                return OCRResponse(
+                    text=cached["text"],
+                    confidence=cached.get("confidence"),
+                    processing_time=processing_time,
+                    model_used=cached.get("model_used"),
+                    cache_hit=True
+                )
+            
+            # モデル・前処理設定の変更前の結果があれば stale として返し、再計算はバックグラウンドに回す
+            stale = await stale_lookup(file_sha256, options_digest(options))
+            if stale is not None:
+                stale_key, cached = stale
+                stale_rewarmer.request(raw_key, content)
+                processing_time = time.time() - start_time
+                logger.info(f"旧バージョンのキャッシュを返却: {file.filename} ({processing_time:.3f}秒)")
+                response.headers["ETag"] = result_etag(stale_key)
+                return OCRResponse(
+                    text=cached["text"],
+                    confidence=cached.get("confidence"),
+                    processing_time=processing_time,
+                    model_used=cached.get("model_used"),
+                    cache_hit=True,
+                    stale=True
+                )
+        
+        # 画像最適化（近似一致検索が有効なら知覚ハッシュも同時に計算）
+        # CPU処理はプールで実行し、その間もイベントループは他のリクエストを処理する
+        try:
+            preprocessed = await preprocess_pool.run(content, with_fingerprint=PHASH_ENABLED)
+        except PreprocessUnavailable as e:
+            raise HTTPException(status_code=e.status_code, detail=str(e), headers={"Retry-After": "1"})
+        optimized_image = preprocessed.data
+        
+        # 結果キャッシュを確認（同じ画像・同じオプションなら推論を省略）
+        cache_key = result_cache_key(optimized_image, options)
+        if has_hf_config and RESULT_CACHE_ENABLED:
+            cached = await cache_lookup(cache_key)
+            if cached is None and PHASH_ENABLED and preprocessed.fingerprint is not None:
+                cached = await near_duplicate_lookup(cache_key, preprocessed.fingerprint)
+            if cached is not None:
+                processing_time = time.time() - start_time
+                logger.info(f"キャッシュヒット: {file.filename} ({processing_time:.3f}秒)")
+                await raw_digest_store(raw_key, cache_key)
+                response.headers["ETag"] = result_etag(cache_key)
+                return OCRResponse(
+                    text=cached["text"],
+                    confidence=cached.get("confidence"),
+                    processing_time=processing_time,
+                    model_used=cached.get("model_used"),
+                    cache_hit=True
+                )
         
         # HuggingFace Space APIでOCR処理
         extracted_text = ""
@@ -267,7 +3325,15 @@ async def process_ocr(file: UploadFile = File(...)):
                 # HuggingFace Space APIを呼び出し
                 logger.info("HuggingFace Space APIでOCR処理を開始...")
                 
-                result = await call_huggingface_space_api(optimized_image)
+                # 同じ画像の同時リクエストは1回の上流呼び出しにまとめる
+                # クライアント切断時は（他に待機者がいなければ）上流の処理を取り消す
+                result = await run_until_disconnected(
+                    request,
+                    single_flight.do(
+                        cache_key,
+                        lambda: load_ocr_result(cache_key, optimized_image, preprocessed.fingerprint)
+                    )
+                )
                 
                 extracted_text = result.get("text", "")
                 confidence = result.get("confidence", 0.95)
@@ -280,6 +3346,11 @@ async def process_ocr(file: UploadFile = File(...)):
                 
                 logger.info(f"OCR処理成功: {len(extracted_text)}文字, 信頼度: {confidence:.1%}")
                 
+                # 次回以降は元ファイルのハッシュだけで結果を問い合わせられる
+                if RESULT_CACHE_ENABLED:
+                    await raw_digest_store(raw_key, cache_key)
+                    response.headers["ETag"] = result_etag(cache_key)
+                
             else:
                 # デモモード（HuggingFace Space未設定時）
                 logger.info("デモモードでOCR処理をシミュレート...")
@@ -309,6 +3380,8 @@ async def process_ocr(file: UploadFile = File(...)):
                 confidence = 1.0
                 model_used = "demo_mode"
                 
+        except ClientDisconnected:
+            raise
         except Exception as hf_error:
             logger.error(f"HuggingFace Space API エラー: {hf_error}")
             
@@ -326,7 +3399,7 @@ async def process_ocr(file: UploadFile = File(...)):
 4. Space名の環境変数設定確認
 
 📊 **設定状況**:
-- HUGGINGFACE_SPACE_URL: {"設定済み" if HUGGINGFACE_SPACE_URL else "未設定"}
+- HUGGINGFACE_SPACE_URL(S): {"設定済み" if HUGGINGFACE_SPACE_URLS else "未設定"}
 - HUGGINGFACE_SPACE_NAME: {"設定済み" if HUGGINGFACE_SPACE_NAME else "未設定"}
 
 サポート: Railwayログで詳細を確認してください"""
@@ -347,6 +3420,10 @@ async def process_ocr(file: UploadFile = File(...)):
         
     except HTTPException:
         raise
+    except ClientDisconnected:
+        logger.info(f"クライアント切断のためOCR処理を中止しました: {file.filename}")
+        # 499: Client Closed Request（応答は届かないがログ・メトリクス用）
+        return Response(status_code=499)
     except Exception as e:
         logger.error(f"OCR処理エラー: {e}")
         raise HTTPException(
@@ -354,15 +3431,256 @@ async def process_ocr(file: UploadFile = File(...)):
             detail=f"OCR処理でエラーが発生しました: {str(e)}"
         )
 
+@app.get("/api/v1/ocr/result/{file_sha256}", response_model=OCRResponse)
+async def get_cached_ocr_result(file_sha256: str, request: Request, response: Response):
+    """
+    ハッシュ先行の結果問い合わせ
+    元ファイルのSHA-256でキャッシュ済みの結果を返し、無ければ404（アップロード不要）
+    旧モデル・旧前処理設定の結果しか無い場合は stale=true で返す
+    If-None-Match が ETag に一致すれば304を返す
+    """
+    start_time = time.time()
+    
+    if len(file_sha256) != 64 or any(c not in "0123456789abcdefABCDEF" for c in file_sha256):
+        raise HTTPException(
+            status_code=400,
+            detail="SHA-256（16進数64文字）を指定してください"
+        )
+    
+    file_sha256 = file_sha256.lower()
+    options_hash = options_digest(ocr_options())
+    raw_key = RawDigestIndex.key(file_sha256, options_hash)
+    cache_key = await raw_digest_lookup(raw_key)
+    cached = await cache_lookup(cache_key) if cache_key else None
+    stale = False
+    if cached is None:
+        # 元画像が無いので再計算はできないが、旧バージョンの結果は stale として返す
+        found = await stale_lookup(file_sha256, options_hash)
+        if found is not None:
+            cache_key, cached = found
+            stale = True
+    if cached is None:
+        METRICS["hash_lookup_misses"] += 1
+        raise HTTPException(
+            status_code=404,
+            detail="キャッシュされた結果がありません"
+        )
+    
+    METRICS["hash_lookup_hits"] += 1
+    etag = result_etag(cache_key)
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers={"ETag": etag})
+    
+    response.headers["ETag"] = etag
+    return OCRResponse(
+        text=cached["text"],
+        confidence=cached.get("confidence"),
+        processing_time=time.time() - start_time,
+        model_used=cached.get("model_used"),
+        cache_hit=True,
+        stale=stale
+    )
+
+
+async def read_limited_body(request: Request, max_bytes: int) -> bytes:
+    """リクエスト本文を上限付きで読む（超えたら読み終える前に413）"""
+    content_length = request.headers.get("content-length")
+    if content_length and content_length.isdigit() and int(content_length) > max_bytes:
+        raise HTTPException(status_code=413, detail="リクエスト本文が大きすぎます")
+    body = bytearray()
+    async for chunk in request.stream():
+        body.extend(chunk)
+        if len(body) > max_bytes:
+            raise HTTPException(status_code=413, detail="リクエスト本文が大きすぎます")
+    return bytes(body)
+
+@app.post("/api/v1/internal/cache/{key}")
+async def serve_peer_cache(key: str, request: Request):
+    """
+    分散キャッシュの担当ノードとして他ノードからの問い合わせに答える
+    本文は最適化済み画像。キャッシュに無ければ SingleFlight でOCRを1回だけ実行する
+    （ここから更に他ノードへは転送しない）
+    """
+    if peer_group is None:
+        raise HTTPException(status_code=404, detail="Not Found")
+    token = request.headers.get("x-peer-token")
+    if not CACHE_PEER_TOKEN or not token:
+        raise HTTPException(status_code=403, detail="ピアトークンがありません")
+    if not hmac.compare_digest(token.encode(), CACHE_PEER_TOKEN.encode()):
+        raise HTTPException(status_code=401, detail="ピアトークンが正しくありません")
+    if not configured_upstream_methods():
+        raise HTTPException(status_code=503, detail="HuggingFace Spaceが設定されていません")
+
+    image_data = await read_limited_body(request, MAX_UPLOAD_BYTES)
+    content_hash, _, options_hash = key.partition(":")
+    if content_hash != hashlib.sha256(image_data).hexdigest():
+        raise HTTPException(status_code=400, detail="キーと画像の内容が一致しません")
+    if options_hash != options_digest(ocr_options()):
+        # ノード間でモデル・前処理設定が食い違っている（デプロイ途中など）
+        raise HTTPException(status_code=409, detail="OCRオプションの名前空間が一致しません")
+
+    fingerprint_header = request.headers.get("x-peer-fingerprint")
+    try:
+        fingerprint = int(fingerprint_header, 16) if fingerprint_header else None
+    except ValueError:
+        fingerprint = None
+
+    peer_group.served += 1
+    entry = await cache_lookup(key) if RESULT_CACHE_ENABLED else None
+    if entry is None:
+        try:
+            entry = await single_flight.do(
+                key, lambda: fetch_ocr_result(key, image_data, fingerprint)
+            )
+        except Exception as e:
+            kind = e.kind if isinstance(e, UpstreamError) else UpstreamError.TRANSPORT
+            return JSONResponse(status_code=502, content={"detail": str(e), "kind": kind})
+    return {
+        "text": entry.get("text", ""),
+        "confidence": entry.get("confidence", 0.95),
+        "model_used": entry.get("model_used", "dots.ocr (GOT-OCR2_0)"),
+    }
+
+
+def require_admin(request: Request) -> DiskResultCache:
+    """管理APIの認証（X-Admin-Token）。ADMIN_TOKEN未設定なら管理APIは存在しない扱い"""
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=404, detail="Not Found")
+    token = request.headers.get("x-admin-token", "")
+    if not hmac.compare_digest(token.encode(), ADMIN_TOKEN.encode()):
+        raise HTTPException(status_code=401, detail="管理トークンが正しくありません")
+    if disk_result_cache is None:
+        raise HTTPException(status_code=503, detail="ディスクキャッシュが無効です")
+    return disk_result_cache
+
+
+@app.get("/api/v1/admin/cache/export")
+async def export_result_cache(request: Request):
+    """
+    ディスクキャッシュをJSONLでストリーミング出力する（移行前のスナップショット用）
+    CACHE_TRANSFER_CHUNK_SIZE 件ずつ読み出すのでメモリ使用量は件数に依存しない
+    """
+    cache = require_admin(request)
+
+    async def generate():
+        after_key = ""
+        while True:
+            records = await asyncio.to_thread(cache.export_chunk, after_key, CACHE_TRANSFER_CHUNK_SIZE)
+            if not records:
+                return
+            yield "".join(format_cache_record(record) for record in records)
+            after_key = records[-1]["key"]
+
+    return StreamingResponse(
+        generate(),
+        media_type="application/x-ndjson",
+        headers={"Content-Disposition": 'attachment; filename="ocr_cache.jsonl"'}
+    )
+
+
+@app.post("/api/v1/admin/cache/import")
+async def import_result_cache(request: Request):
+    """
+    JSONL（1行1件: content_hash, options_hash または options, text, confidence, model_used）を
+    ストリーミングで受け取り、CACHE_TRANSFER_CHUNK_SIZE 件ずつディスクキャッシュへ投入する
+    """
+    cache = require_admin(request)
+    counts = {"imported": 0, "skipped": 0}
+    chunk = []
+    buffer = b""
+
+    async def flush():
+        imported = await asyncio.to_thread(cache.import_records, chunk)
+        counts["imported"] += imported
+        counts["skipped"] += len(chunk) - imported
+        chunk.clear()
+
+    async for data in request.stream():
+        buffer += data
+        *lines, buffer = buffer.split(b"\n")
+        # 改行の無い巨大な入力でメモリを使い切らないよう、1行の長さを制限（16MB）
+        if len(buffer) > 16 * 1024 * 1024:
+            raise HTTPException(
+                status_code=413,
+                detail=f"1行が大きすぎます（投入済み: {counts['imported']}件）"
+            )
+        for line in lines:
+            if not line.strip():
+                continue
+            record = parse_cache_record(line)
+            if record is None:
+                counts["skipped"] += 1
+                continue
+            chunk.append(record)
+            if len(chunk) >= CACHE_TRANSFER_CHUNK_SIZE:
+                await flush()
+    if buffer.strip():
+        record = parse_cache_record(buffer)
+        if record is None:
+            counts["skipped"] += 1
+        else:
+            chunk.append(record)
+    if chunk:
+        await flush()
+
+    logger.info(f"キャッシュをインポートしました: {counts}")
+    return counts
+
+
 @app.get("/api/v1/status")
 async def get_status():
-    """システム状態を返す"""
+    """システム状態を返す（metrics は複数ワーカー時は全ワーカーの合計、それ以外はこのワーカーの値）"""
+    aggregated = await shared_metrics.totals() if shared_metrics is not None else None
     return {
         "api_status": "running",
+        "worker": {
+            "pid": os.getpid(),
+            "workers": GATEWAY_WORKERS,
+            "reporting_workers": aggregated["workers"] if aggregated else None,
+            "active_workers": aggregated["active_workers"] if aggregated else None,
+            "metrics": dict(METRICS),
+        },
         "ocr_provider": "HuggingFace Space + dots.ocr",
-        "huggingface_space_configured": bool(HUGGINGFACE_SPACE_URL or HUGGINGFACE_SPACE_NAME),
+        "huggingface_space_configured": bool(HUGGINGFACE_SPACE_URLS or HUGGINGFACE_SPACE_NAME),
         "huggingface_space_url": HUGGINGFACE_SPACE_URL if HUGGINGFACE_SPACE_URL else None,
         "huggingface_space_name": HUGGINGFACE_SPACE_NAME if HUGGINGFACE_SPACE_NAME else None,
+        "gradio_client_pool": gradio_client_pool.stats() if gradio_client_pool else None,
+        "upstream_concurrency": upstream_limiter.stats(),
+        "upstream_strategy": {
+            "strategy": UPSTREAM_STRATEGY,
+            "methods": configured_upstream_methods(),
+            "last_method": upstream_selection["last_method"],
+            "circuit_breakers": {
+                method: circuit_breakers[method].stats() for method in configured_upstream_methods()
+            },
+        },
+        "huggingface_space_urls": HUGGINGFACE_SPACE_URLS,
+        "space_warmth": space_keep_warm.stats(),
+        "stale_rewarm": stale_rewarmer.stats(),
+        "preprocess_pool": preprocess_pool.stats(),
+        "peer_cache": peer_group.stats() if peer_group else None,
+        "upstream_latency": upstream_latency.stats(),
+        "retry_budget": retry_budget.stats(),
+        "single_flight": single_flight.stats(),
+        "result_cache": result_cache.stats(),
+        "perceptual_index": perceptual_index.stats(),
+        "raw_digest_index": raw_digest_index.stats(),
+        "disk_result_cache": await disk_result_cache.stats() if disk_result_cache else None,
+        "upstream_timeouts": upstream_budget(upstream_latency.median_pixels())._asdict(),
+        "hedging": {
+            "enabled": HEDGE_ENABLED,
+            "percentile": HEDGE_PERCENTILE,
+            "current_delay": hedge_delay(),
+            "hedge_rate": METRICS["hedges_fired"] / max(1, METRICS["upstream_requests"]),
+        },
+        "metrics": aggregated["metrics"] if aggregated else dict(METRICS),
+        "replica_pool": replica_pool.stats() if replica_pool else None,
+        "http_pool": {
+            "limit": HTTP_POOL_LIMIT,
+            "limit_per_host": HTTP_POOL_LIMIT_PER_HOST,
+            "keepalive_timeout": HTTP_KEEPALIVE_TIMEOUT,
+            "dns_cache_ttl": HTTP_DNS_CACHE_TTL,
+        },
         "memory_limit": "512MB (Railway $5 plan)",
         "supported_formats": ["PNG", "JPEG", "GIF", "BMP", "WebP"],
         "max_file_size": "10MB",
@@ -375,14 +3693,102 @@ async def get_status():
         }
     }
 
+def available_cpus() -> int:
+    """このプロセスが使えるCPU数（cgroupのCPUクォータ・アフィニティを考慮）"""
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+    try:
+        with open("/sys/fs/cgroup/cpu.max") as f:
+            quota, period = f.read().split()
+        if quota != "max":
+            cpus = min(cpus, max(1, int(int(quota) / int(period))))
+    except (OSError, ValueError):
+        pass
+    return max(1, cpus)
+
+
+def memory_budget_mb() -> int:
+    """ワーカーに割り当てられるメモリ（MEMORY_BUDGET_MB、cgroupの上限、物理メモリの順）"""
+    if MEMORY_BUDGET_MB > 0:
+        return MEMORY_BUDGET_MB
+    for path in ("/sys/fs/cgroup/memory.max", "/sys/fs/cgroup/memory/memory.limit_in_bytes"):
+        try:
+            with open(path) as f:
+                value = f.read().strip()
+        except OSError:
+            continue
+        # cgroup v1 の「無制限」は巨大な値になる
+        if value != "max" and int(value) < 1 << 60:
+            return int(value) // (1024 * 1024)
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") // (1024 * 1024)
+    except (ValueError, OSError):
+        return WORKER_MEMORY_MB
+
+
+def worker_memory_mb() -> int:
+    """1ワーカーあたりのメモリ見積もり（プロセスプールなら最低1つの子プロセスを含む）"""
+    child = PREPROCESS_CHILD_MEMORY_MB if PREPROCESS_EXECUTOR == "process" else 0
+    return max(1, WORKER_MEMORY_MB + child)
+
+
+def shared_memory_mb() -> int:
+    """
+    ワーカー数で分け合うメモリ上のキャッシュの合計（ワーカー数によらず一定なので予算から先に引く）
+    """
+    shared = RAW_DIGEST_MEMORY_MAX_BYTES
+    if PHASH_ENABLED:
+        shared += PHASH_INDEX_MAX_ENTRIES * PerceptualIndex.ENTRY_BYTES
+    return shared // (1024 * 1024)
+
+
+def gateway_worker_count() -> int:
+    """
+    ワーカー数: WEB_CONCURRENCY が指定されていればそれを使い、
+    無ければCPU数とメモリ予算（共有キャッシュ分を除き、1ワーカーあたり worker_memory_mb()）の小さい方
+    Pillowによる画像最適化はCPUを使うため、コア数までワーカーを増やすとほぼ比例して処理量が伸びる
+    """
+    if WEB_CONCURRENCY > 0:
+        return WEB_CONCURRENCY
+    return max(1, min(available_cpus(), (memory_budget_mb() - shared_memory_mb()) // worker_memory_mb()))
+
+
+def preprocess_worker_count() -> int:
+    """
+    画像最適化プールの大きさ: ホストのコアをゲートウェイのワーカー間で分け合い、
+    プロセスプールの場合はこのワーカーに残るメモリ予算に収まる子プロセス数までに抑える
+    """
+    workers = max(1, available_cpus() // GATEWAY_WORKERS)
+    if PREPROCESS_EXECUTOR == "process":
+        spare = (memory_budget_mb() - shared_memory_mb()) // GATEWAY_WORKERS - WORKER_MEMORY_MB
+        workers = min(workers, spare // max(1, PREPROCESS_CHILD_MEMORY_MB))
+    return max(1, workers)
+
+
 if __name__ == "__main__":
-    import uvicorn
-    
     port = int(os.getenv("PORT", 8000))
-    uvicorn.run(
-        "main:app",
-        host="0.0.0.0",
-        port=port,
-        reload=False,  # 本番環境では無効化
-        log_level="info"
-    )
\ No newline at end of file
+    workers = gateway_worker_count()
+    if workers > 1:
+        # ワーカーは環境変数を引き継ぐ（ワーカー数と、起動ごとのメトリクス集計先）
+        os.environ["GATEWAY_WORKERS"] = str(workers)
+        if not METRICS_DB_PATH:
+            metrics_path = os.path.join(tempfile.gettempdir(), f"ocr_gateway_metrics_{os.getpid()}.sqlite3")
+            for suffix in ("", "-wal", "-shm"):
+                if os.path.exists(metrics_path + suffix):
+                    os.remove(metrics_path + suffix)
+            os.environ["METRICS_DB_PATH"] = metrics_path
+        if not RESULT_CACHE_DB_PATH:
+            logger.warning("RESULT_CACHE_DB_PATH が空のため、結果キャッシュはワーカー間で共有されません")
+    logger.info(f"ワーカー数: {workers}（CPU: {available_cpus()}, メモリ予算: {memory_budget_mb()}MB）")
+    # uvicorn をモジュールとして起動し直す（本番環境ではリロード無効）
+    # main.py が __main__ のままだと、spawn で起動する画像最適化プールの子プロセスが
+    # main.py（gradio_client・FastAPIなど）を丸ごと読み込み直してしまう
+    os.execv(sys.executable, [
+        sys.executable, "-m", "uvicorn", "main:app",
+        "--host", "0.0.0.0",
+        "--port", str(port),
+        "--workers", str(workers),
+        "--log-level", "info",
+    ])
\ No newline at end of file
@@ -0,0 +1,39 @@
+"""
+main.py の単体テスト共通設定
+main はインポート時に環境変数から設定を読むため、ディスクキャッシュ・キープウォームなどを無効にしてから読み込む
+"""
+
+import os
+import sys
+
+os.environ.setdefault("RESULT_CACHE_DB_PATH", "")
+os.environ.setdefault("METRICS_DB_PATH", "")
+os.environ.setdefault("KEEP_WARM_ENABLED", "false")
+os.environ.setdefault("HUGGINGFACE_SPACE_NAME", "")
+os.environ.setdefault("HUGGINGFACE_SPACE_URLS", "")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest  # noqa: E402
+
+import main  # noqa: E402
+
+
+class FakeClock:
+    """time.monotonic の代わりに使う手動で進める時計"""
+
+    def __init__(self, now: float = 1000.0):
+        self.now = now
+
+    def __call__(self) -> float:
+        return self.now
+
+    def advance(self, seconds: float) -> None:
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch) -> FakeClock:
+    fake = FakeClock()
+    monkeypatch.setattr(main.time, "monotonic", fake)
+    return fake
@@ -0,0 +1,58 @@
+import json
+
+import pytest
+
+from main import ocr_options, options_digest, parse_cache_record
+
+CONTENT_HASH = "ab" * 32
+
+
+def record_line(**fields) -> str:
+    record = {"content_hash": CONTENT_HASH, "options_hash": "0123456789abcdef", "text": "本文"}
+    record.update(fields)
+    return json.dumps(record, ensure_ascii=False)
+
+
+def test_valid_record_is_normalized():
+    record = parse_cache_record(record_line(
+        content_hash=CONTENT_HASH.upper(), confidence=1, model_used="m", created_at=10,
+        phash="ABCD", file_sha256="CD" * 32,
+    ))
+    assert record == {
+        "content_hash": CONTENT_HASH,
+        "options_hash": "0123456789abcdef",
+        "text": "本文",
+        "confidence": 1.0,
+        "model_used": "m",
+        "created_at": 10.0,
+        "phash": "abcd",
+        "file_sha256": ["cd" * 32],
+    }
+
+
+def test_options_are_digested_when_no_options_hash():
+    line = json.dumps({"content_hash": CONTENT_HASH, "options": ocr_options(), "text": "t"})
+    assert parse_cache_record(line)["options_hash"] == options_digest(ocr_options())
+
+
+def test_invalid_file_hashes_are_dropped():
+    record = parse_cache_record(record_line(file_sha256=["cd" * 32, "short", 5]))
+    assert record["file_sha256"] == ["cd" * 32]
+
+
+@pytest.mark.parametrize("line", [
+    "not json",
+    "[]",
+    record_line(text=None),
+    record_line(content_hash="xyz"),
+    record_line(options_hash=""),
+    record_line(options_hash="a:b"),
+    record_line(phash="not-hex"),
+    record_line(phash=""),
+    record_line(phash=123),
+    record_line(confidence="high"),
+    record_line(confidence=True),
+    record_line(model_used=3),
+])
+def test_invalid_records_are_skipped(line):
+    assert parse_cache_record(line) is None
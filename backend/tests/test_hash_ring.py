@@ -0,0 +1,35 @@
+from collections import Counter
+
+from main import HashRing
+
+NODES = ["http://node-a", "http://node-b", "http://node-c"]
+KEYS = [f"{i:064x}:0123456789abcdef" for i in range(3000)]
+
+
+def test_ownership_is_deterministic():
+    first = HashRing(NODES, 100)
+    second = HashRing(list(reversed(NODES)), 100)
+    assert all(first.node_for(key) == second.node_for(key) for key in KEYS)
+
+
+def test_keys_spread_across_all_nodes():
+    ring = HashRing(NODES, 100)
+    counts = Counter(ring.node_for(key) for key in KEYS)
+    assert set(counts) == set(NODES)
+    assert min(counts.values()) > len(KEYS) / len(NODES) / 2
+
+
+def test_adding_a_node_only_moves_keys_to_that_node():
+    before = HashRing(NODES, 100)
+    after = HashRing(NODES + ["http://node-d"], 100)
+    moved = [key for key in KEYS if before.node_for(key) != after.node_for(key)]
+    assert all(after.node_for(key) == "http://node-d" for key in moved)
+    assert len(moved) < len(KEYS) / 2
+
+
+def test_removing_a_node_keeps_other_owners():
+    before = HashRing(NODES, 100)
+    after = HashRing(NODES[:2], 100)
+    for key in KEYS:
+        if before.node_for(key) != "http://node-c":
+            assert after.node_for(key) == before.node_for(key)
@@ -0,0 +1,38 @@
+import pytest
+
+from main import RetryBudget
+
+
+def test_starts_full_and_runs_dry(clock):
+    budget = RetryBudget(ratio=0.1, min_per_second=0.0, max_tokens=2)
+    assert budget.try_spend()
+    assert budget.try_spend()
+    assert not budget.try_spend()
+    assert budget.exhausted == 1
+
+
+def test_requests_earn_ratio_tokens(clock):
+    budget = RetryBudget(ratio=0.25, min_per_second=0.0, max_tokens=1)
+    assert budget.try_spend()
+    for _ in range(3):
+        budget.record_request()
+    assert not budget.try_spend()
+    budget.record_request()
+    assert budget.try_spend()
+
+
+def test_time_refills_at_the_minimum_rate(clock):
+    budget = RetryBudget(ratio=0.0, min_per_second=0.5, max_tokens=1)
+    assert budget.try_spend()
+    clock.advance(1)
+    assert not budget.try_spend()
+    clock.advance(1)
+    assert budget.try_spend()
+
+
+def test_tokens_never_exceed_the_cap(clock):
+    budget = RetryBudget(ratio=1.0, min_per_second=1.0, max_tokens=3)
+    for _ in range(10):
+        budget.record_request()
+    clock.advance(100)
+    assert budget.stats()["tokens"] == pytest.approx(3)
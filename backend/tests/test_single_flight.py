@@ -0,0 +1,107 @@
+import asyncio
+
+from main import SingleFlight
+
+
+def test_concurrent_calls_share_one_execution():
+    async def scenario():
+        flight = SingleFlight()
+        calls = 0
+        release = asyncio.Event()
+
+        async def work():
+            nonlocal calls
+            calls += 1
+            await release.wait()
+            return "result"
+
+        waiters = [asyncio.create_task(flight.do("key", work)) for _ in range(3)]
+        await asyncio.sleep(0)
+        release.set()
+        results = await asyncio.gather(*waiters)
+        return calls, results, flight.stats()
+
+    calls, results, stats = asyncio.run(scenario())
+    assert calls == 1
+    assert results == ["result"] * 3
+    assert stats == {"in_flight": 0, "coalesced": 2}
+
+
+def test_work_continues_while_another_waiter_remains():
+    async def scenario():
+        flight = SingleFlight()
+        release = asyncio.Event()
+
+        async def work():
+            await release.wait()
+            return "result"
+
+        first = asyncio.create_task(flight.do("key", work))
+        second = asyncio.create_task(flight.do("key", work))
+        await asyncio.sleep(0)
+        first.cancel()
+        await asyncio.sleep(0)
+        release.set()
+        return first, await second
+
+    first, second_result = asyncio.run(scenario())
+    assert first.cancelled()
+    assert second_result == "result"
+
+
+def test_work_is_cancelled_when_no_waiters_remain():
+    async def scenario():
+        flight = SingleFlight()
+        cancelled = asyncio.Event()
+
+        async def work():
+            try:
+                await asyncio.sleep(60)
+            except asyncio.CancelledError:
+                cancelled.set()
+                raise
+
+        waiter = asyncio.create_task(flight.do("key", work))
+        await asyncio.sleep(0)
+        waiter.cancel()
+        await asyncio.wait_for(cancelled.wait(), 1)
+        return flight.stats()
+
+    assert asyncio.run(scenario())["in_flight"] == 0
+
+
+def test_new_call_after_abandoned_flight_starts_fresh_work():
+    async def scenario():
+        flight = SingleFlight()
+
+        async def slow():
+            await asyncio.sleep(60)
+
+        async def fast():
+            return "fresh"
+
+        waiter = asyncio.create_task(flight.do("key", slow))
+        await asyncio.sleep(0)
+        waiter.cancel()
+        await asyncio.sleep(0)
+        return await flight.do("key", fast), flight.stats()
+
+    result, stats = asyncio.run(scenario())
+    assert result == "fresh"
+    assert stats == {"in_flight": 0, "coalesced": 0}
+
+
+def test_errors_are_delivered_to_every_waiter():
+    async def scenario():
+        flight = SingleFlight()
+
+        async def failing():
+            await asyncio.sleep(0)
+            raise ValueError("boom")
+
+        return await asyncio.gather(
+            flight.do("key", failing), flight.do("key", failing), return_exceptions=True
+        )
+
+    results = asyncio.run(scenario())
+    assert all(isinstance(r, ValueError) for r in results)